@@ -8,11 +8,50 @@ from typing import Callable,Any,List,Union
 import tempfile
 import random
 import time
+import json
+import asyncio
+import urllib.parse
+import socket
+import urllib3
+import hashlib
+import zlib
+import base64
+import heapq
+import io
+import bisect
+import shutil
+import cProfile
+import tracemalloc
+import email.utils
+import multiprocessing
+import concurrent.futures
+import weakref
+import contextlib
+try:
+    import crc32c
+except ImportError:
+    crc32c=None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp=None
+try:
+    import fcntl
+except ImportError:
+    fcntl=None
+try:
+    import httpx
+except ImportError:
+    httpx=None
 class ConnectError(Exception):
-    def __init__(self,url:str) -> None:
-        super().__init__(self)
+    def __init__(self,url:str,status:Union[None,int]=None,retryAfter:Union[None,float]=None) -> None:
+        super().__init__(url,status,retryAfter)
         self.url=url
+        self.status=status
+        self.retryAfter=retryAfter
     def __str__(self) -> str:
+        if self.status!=None:
+            return "Can not connect to %s, the status is %d" % (self.url,self.status)
         return "Can not connect to %s" % self.url
 class ZeroSizeError(Exception):
     def __init__(self,url:str) -> None:
@@ -20,6 +59,966 @@ class ZeroSizeError(Exception):
         self.url=url
     def __str__(self) -> str:
         return "Can not get the  size of %s" % self.url
+class ChecksumError(Exception):
+    def __init__(self,url:str,expected:str,got:str) -> None:
+        super().__init__(url,expected,got)
+        self.url=url
+        self.expected=expected
+        self.got=got
+    def __str__(self) -> str:
+        return "The checksum of %s is %s, but %s is expected" % (self.url,self.got,self.expected)
+class MirrorError(Exception):
+    def __init__(self,url:str) -> None:
+        super().__init__(url)
+        self.url=url
+    def __str__(self) -> str:
+        return "The file on the mirror %s is not the same" % self.url
+def _gf2Times(mat:List[int],vec:int)->int:
+    num=0
+    i=0
+    while vec:
+        if vec&1:
+            num^=mat[i]
+        vec>>=1
+        i+=1
+    return num
+def _gf2Square(mat:List[int])->List[int]:
+    return [_gf2Times(mat,mat[i]) for i in range(32)]
+def _crcCombine(crc1:int,crc2:int,len2:int,poly:int)->int:
+    """
+    Work out the crc of A+B by the crc of A and the crc of B, the same as crc32_combine of zlib.
+    :param crc1: the crc of A
+    :param crc2: the crc of B
+    :param len2: the length of B
+    :param poly: the reversed polynomial of the crc
+    :return: the crc of A+B
+    """
+    if len2<=0:
+        return crc1
+    odd=[poly]+[1<<i for i in range(31)]
+    even=_gf2Square(odd)
+    odd=_gf2Square(even)
+    while True:
+        even=_gf2Square(odd)
+        if len2&1:
+            crc1=_gf2Times(even,crc1)
+        len2>>=1
+        if not len2:
+            break
+        odd=_gf2Square(even)
+        if len2&1:
+            crc1=_gf2Times(odd,crc1)
+        len2>>=1
+        if not len2:
+            break
+    return crc1^crc2
+class _Crc:
+    """
+    A crc32 or crc32c checksum like a hashlib object, which can be combined with the checksum of the data after it.
+    crc32c needs the crc32c package.
+    """
+    def __init__(self,name:str) -> None:
+        self.name=name
+        if name=="crc32":
+            self._update=zlib.crc32
+            self.poly=0xEDB88320
+        elif crc32c!=None:
+            self._update=crc32c.crc32c
+            self.poly=0x82F63B78
+        else:
+            raise ValueError("crc32c needs the crc32c package. Install it by 'pip install crc32c'")
+        self.value=0
+        self.length=0
+    def update(self,data)->None:
+        self.value=self._update(data,self.value)
+        self.length+=len(data)
+    def combine(self,other:"_Crc")->None:
+        """
+        Append the checksum of the data after ours.
+        :param other: the checksum of the data after ours
+        """
+        self.value=_crcCombine(self.value,other.value,other.length,self.poly)
+        self.length+=other.length
+    def hexdigest(self)->str:
+        return "%08x"%self.value
+class _ConnectTimer:
+    """
+    A mixin of the urllib3 connections which keeps the seconds the connect took, with the TLS handshake, until the response on the connection takes them.
+    """
+    connectTime:Union[None,float]=None
+    def connect(self)->None:
+        begin=time.time()
+        super().connect()
+        self.connectTime=time.time()-begin
+class _TimedHTTPConnection(_ConnectTimer,urllib3.connection.HTTPConnection):
+    pass
+class _TimedHTTPSConnection(_ConnectTimer,urllib3.connection.HTTPSConnection):
+    pass
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls=_TimedHTTPConnection
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls=_TimedHTTPSConnection
+class _TimedAdapter(requests.adapters.HTTPAdapter):
+    """
+    A HTTPAdapter which times the connect of every new connection, and sets extra socket options on it.
+    """
+    def __init__(self,socketOptions:Union[None,list]=None,**kwargs) -> None:
+        self.socketOptions=socketOptions or []
+        super().__init__(**kwargs)
+    def init_poolmanager(self,*args,**kwargs):
+        if self.socketOptions:
+            kwargs["socket_options"]=urllib3.connection.HTTPConnection.default_socket_options+self.socketOptions
+        super().init_poolmanager(*args,**kwargs)
+        self.poolmanager.pool_classes_by_scheme={"http":_TimedHTTPConnectionPool,"https":_TimedHTTPSConnectionPool}
+def _connectTime(response)->Union[None,float]:
+    """
+    Take the seconds the connection of a response took to connect.
+    :param response: a requests response, or a _Http2Response
+    :return: the seconds. 0 if the connection was kept from an earlier request, and None if the connection isn't timed, like the one of a session we didn't make
+    """
+    if isinstance(response,_Http2Response):
+        return response.connectTime
+    connection=getattr(response.raw,"connection",None)
+    if not isinstance(connection,_ConnectTimer):
+        return None
+    value=connection.connectTime or 0
+    connection.connectTime=0
+    return value
+class _Http2Response:
+    """
+    A streamed httpx response which looks like a streamed requests response to the download threads.
+    """
+    def __init__(self,response:"httpx.Response",connectTime:float) -> None:
+        self.response=response
+        self.status_code=response.status_code
+        self.headers=response.headers
+        self.httpVersion=response.http_version
+        self.connectTime=connectTime
+        self.raw=None
+    def iter_content(self,chunk_size:int=1):
+        """
+        Iterate over the data as it comes. chunk_size is ignored, so that the frames of the stream are not cut into small pieces.
+        """
+        return self.response.iter_bytes()
+    def close(self)->None:
+        self.response.close()
+class _Http2Session:
+    """
+    Send the requests as HTTP/2 streams on a few connections by httpx. The requests take the connections in turn.
+    If the server only speaks HTTP/1.1, httpx falls back to it.
+    """
+    def __init__(self,connections:int,verify:Union[bool,str]=True) -> None:
+        """
+        New a _Http2Session object
+        :param connections: the num of connections
+        :param verify: the verify of the requests session, to check the certificates in the same way
+        """
+        self.clients=[httpx.Client(http2=True,verify=verify,follow_redirects=True) for i in range(max(connections,1))]
+        self._turn=0
+    def get(self,url:str,headers:dict,stream:bool=True,timeout:Union[int,None]=None)->_Http2Response:
+        client=self.clients[self._turn%len(self.clients)]
+        self._turn+=1
+        times:dict={}
+        def trace(name:str,info:dict)->None:
+            if name=="connection.connect_tcp.started":
+                times["begin"]=time.time()
+            elif name in ["connection.connect_tcp.complete","connection.start_tls.complete"]:
+                times["end"]=time.time()
+        response=client.send(client.build_request("GET",url,headers=headers,timeout=timeout,extensions={"trace":trace}),stream=True)
+        return _Http2Response(response,times["end"]-times["begin"] if "end" in times else 0)
+    def close(self)->None:
+        for i in self.clients:
+            i.close()
+def _makeSession(poolSize:int,socketBufferSize:int=0)->requests.Session:
+    """
+    Make a requests session with a connection pool.
+    :param poolSize: max num of connections kept for one host
+    :param socketBufferSize: the SO_RCVBUF of every connection. If it's less than 1, the system default is used
+    :return: the session
+    """
+    session=requests.Session()
+    if socketBufferSize>=1:
+        adapter=_TimedAdapter([(socket.SOL_SOCKET,socket.SO_RCVBUF,socketBufferSize)],pool_maxsize=poolSize)
+    else:
+        adapter=_TimedAdapter(pool_maxsize=poolSize)
+    session.mount("http://",adapter)
+    session.mount("https://",adapter)
+    return session
+def _retryAfter(headers)->Union[None,float]:
+    """
+    Read the Retry-After header. It's seconds or an HTTP date.
+    :param headers: the headers of the response
+    :return: the seconds to wait. None if there is no Retry-After
+    """
+    value=headers.get("retry-after")
+    if value==None:
+        return None
+    try:
+        return max(float(value),0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp()-time.time(),0)
+    except (TypeError,ValueError,IndexError):
+        return None
+class RetryPolicy:
+    """
+    How to wait before a retry: exponential backoff with jitter, the Retry-After of 429 and 503, and a circuit breaker for every host.
+    One policy can be shared by many downloads, so that they share the circuit breakers.
+    """
+    def __init__(self,baseDelay:float=0.5,maxDelay:float=30,multiplier:float=2,jitter:bool=True,maxRetryAfter:float=300,breakerThreshold:int=10,breakerCooldown:float=10) -> None:
+        """
+        New a RetryPolicy object
+        :param baseDelay: the delay before the first retry, in seconds
+        :param maxDelay: max delay of the backoff, in seconds
+        :param multiplier: the delay is multiplied by it after every retry
+        :param jitter: whether to wait a random time between 0 and the delay, so that the parts don't retry at the same time
+        :param maxRetryAfter: max seconds to wait for a Retry-After
+        :param breakerThreshold: the circuit breaker of a host opens after this num of failures in a row. If it's less than 1, there is no circuit breaker
+        :param breakerCooldown: seconds the circuit breaker keeps open. After it, the connections to the host are tried again
+        """
+        self.baseDelay=baseDelay
+        self.maxDelay=maxDelay
+        self.multiplier=multiplier
+        self.jitter=jitter
+        self.maxRetryAfter=maxRetryAfter
+        self.breakerThreshold=breakerThreshold
+        self.breakerCooldown=breakerCooldown
+        self._failures:dict={}
+        self._openUntil:dict={}
+        self._lock=threading.Lock()
+    def delay(self,retryNum:int,error:Union[None,BaseException]=None)->float:
+        """
+        Work out the time to wait before a retry.
+        :param retryNum: the num of retries before
+        :param error: the error of the failure. The Retry-After of a ConnectError is honored, and a 429 or 503 waits the whole delay without jitter
+        :return: the seconds to wait
+        """
+        delay=min(self.maxDelay,self.baseDelay*self.multiplier**min(retryNum,64))
+        status=getattr(error,"status",None)
+        retryAfter=getattr(error,"retryAfter",None)
+        if self.jitter and status not in [429,503]:
+            delay=random.uniform(0,delay)
+        if retryAfter!=None:
+            delay=max(delay,min(retryAfter,self.maxRetryAfter))
+        return delay
+    def failure(self,host:str)->None:
+        """
+        Count a failure of the host. The circuit breaker opens if there are too many failures in a row.
+        :param host: the host
+        """
+        if self.breakerThreshold<1:
+            return
+        with self._lock:
+            self._failures[host]=self._failures.get(host,0)+1
+            if self._failures[host]>=self.breakerThreshold:
+                self._openUntil[host]=time.time()+self.breakerCooldown
+    def success(self,host:str)->None:
+        """
+        The host answers. Close the circuit breaker of it.
+        :param host: the host
+        """
+        if self._failures.get(host):
+            with self._lock:
+                self._failures.pop(host,None)
+                self._openUntil.pop(host,None)
+    def wait(self,host:str)->float:
+        """
+        The time until the circuit breaker of the host lets the connections go.
+        :param host: the host
+        :return: the seconds to wait. 0 if the circuit breaker is closed
+        """
+        return max(self._openUntil.get(host,0)-time.time(),0)
+class RateLimiter:
+    """
+    A token bucket of bandwidth, with a total rate and a rate for every host. It can be shared by many downloads.
+    Every chunk takes its turn in the bucket, so the parts which are reading share the rate fairly. The rates can be changed at any time.
+    """
+    def __init__(self,rate:float=0,hostRate:float=0,burst:float=0.25,schedule:Union[None,List[tuple]]=None) -> None:
+        """
+        New a RateLimiter object
+        :param rate: max bytes per second in total. If it's less than or equal to 0, it means infinity
+        :param hostRate: max bytes per second from one host. If it's less than or equal to 0, it means infinity
+        :param burst: the seconds of data which can be taken at once after the bucket is idle
+        :param schedule: the rates of the times of the day. A list of (start,end,rate), e.g. ("09:00","18:00",1024*1024). start and end are local time, and the end can be earlier than the start for a time across midnight. In the other times, rate is used
+        """
+        self.rate=rate
+        self.hostRate=hostRate
+        self.burst=burst
+        self.schedule:List[tuple]=[]
+        self.setSchedule(schedule or [])
+        self._next:float=0
+        self._hostNext:dict={}
+        self._lock=threading.Lock()
+    def setSchedule(self,schedule:List[tuple])->None:
+        """
+        Change the rates of the times of the day.
+        :param schedule: a list of (start,end,rate). See __init__
+        """
+        retsult=[]
+        for start,end,rate in schedule:
+            start=[int(i) for i in start.split(":")]
+            end=[int(i) for i in end.split(":")]
+            retsult.append((start[0]*60+start[1],end[0]*60+end[1],rate))
+        self.schedule=retsult
+    def currentRate(self)->float:
+        """
+        The total rate now, by the schedule.
+        """
+        if self.schedule:
+            now=time.localtime()
+            minute=now.tm_hour*60+now.tm_min
+            for start,end,rate in self.schedule:
+                if start<=minute<end or (end<start and (minute>=start or minute<end)):
+                    return rate
+        return self.rate
+    def reserve(self,length:int,host:Union[None,str]=None)->float:
+        """
+        Take the tokens of the data.
+        :param length: the length of the data
+        :param host: the host the data comes from
+        :return: the seconds to wait before the data is used
+        """
+        rate=self.currentRate()
+        hostRate=self.hostRate if host!=None else 0
+        if rate<=0 and hostRate<=0:
+            return 0
+        now=time.time()
+        delay:float=0
+        with self._lock:
+            if rate>0:
+                self._next=max(self._next,now-self.burst)+length/rate
+                delay=self._next-now
+            if hostRate>0:
+                self._hostNext[host]=max(self._hostNext.get(host,0),now-self.burst)+length/hostRate
+                delay=max(delay,self._hostNext[host]-now)
+        return max(delay,0)
+class BufferPool:
+    """
+    Memory blocks shared by the parts which would be kept in temp files. A part keeps its data in the blocks while the budget lasts, and only the rest of it goes to its temp file.
+    The blocks given back are kept and used again, so the memory isn't allocated for every part.
+    """
+    def __init__(self,budget:int=64*1024*1024,blockSize:int=1024*1024) -> None:
+        """
+        New a BufferPool object
+        :param budget: max bytes of the blocks taken at the same time
+        :param blockSize: the size of one block
+        """
+        self.budget=budget
+        self.blockSize=max(blockSize,1)
+        self.used=0
+        self._free:List[bytearray]=[]
+        self._lock=threading.Lock()
+    def take(self)->Union[None,bytearray]:
+        """
+        Take a block.
+        :return: the block, or None if the budget is used up
+        """
+        with self._lock:
+            if self.used+self.blockSize>self.budget:
+                return None
+            self.used+=self.blockSize
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.blockSize)
+    def give(self,blocks:List[bytearray])->None:
+        """
+        Give back the blocks.
+        :param blocks: the blocks got by take
+        """
+        with self._lock:
+            self.used-=self.blockSize*len(blocks)
+            self._free.extend(blocks)
+class _PartBuffer:
+    """
+    The data of a part. The head of it is in the blocks of a BufferPool, and the rest is spilled to the temp file of the part when the pool has no more blocks.
+    It's written like the temp file, and the blocks go back to the pool when it's released or lost.
+    """
+    def __init__(self,pool:BufferPool,fileName:str) -> None:
+        """
+        New a _PartBuffer object
+        :param pool: the pool to take the blocks from
+        :param fileName: the temp file for the data out of the blocks
+        """
+        self.pool=pool
+        self.fileName=fileName
+        self.blocks:List[bytearray]=[]
+        self.memorySize=0
+        self.spillSize=0
+        self._file:Union[None,io.BufferedWriter]=None
+        weakref.finalize(self,pool.give,self.blocks)
+    def write(self,data)->int:
+        """
+        Append the data. It's copied, so the caller can use its buffer again.
+        :param data: the data
+        :return: the length of the data
+        """
+        view=memoryview(data).cast("B")
+        length=len(view)
+        blockSize=self.pool.blockSize
+        while len(view) and self.spillSize==0:
+            if self.memorySize==len(self.blocks)*blockSize:
+                block=self.pool.take()
+                if block==None:
+                    break
+                self.blocks.append(block)
+            offset=self.memorySize%blockSize
+            num=min(len(view),blockSize-offset)
+            self.blocks[self.memorySize//blockSize][offset:offset+num]=view[:num]
+            self.memorySize+=num
+            view=view[num:]
+        if len(view):
+            if self._file==None:
+                os.makedirs(os.path.dirname(self.fileName),exist_ok=True)
+                self._file=open(self.fileName,"ab")
+            self._file.write(view)
+            self.spillSize+=len(view)
+        return length
+    def truncate(self,size:int)->None:
+        """
+        Drop the data after size, so that the part goes on from it.
+        :param size: the size to keep
+        """
+        self.close()
+        if size>=self.memorySize:
+            if size-self.memorySize<self.spillSize:
+                self.spillSize=size-self.memorySize
+                os.truncate(self.fileName,self.spillSize)
+            return
+        keep=-(-size//self.pool.blockSize)
+        self.pool.give(self.blocks[keep:])
+        del self.blocks[keep:]
+        self.memorySize=size
+        if self.spillSize:
+            self.spillSize=0
+            os.truncate(self.fileName,0)
+    def writeTo(self,wf,length:int,hasher=None)->None:
+        """
+        Write the head of the data into a file.
+        :param wf: the file
+        :param length: the length to write
+        :param hasher: the hasher updated with the data
+        """
+        rest=length
+        for i,block in enumerate(self.blocks):
+            num=min(self.pool.blockSize,self.memorySize-i*self.pool.blockSize,rest)
+            if num<=0:
+                break
+            data=memoryview(block)[:num]
+            wf.write(data)
+            if hasher!=None:
+                hasher.update(data)
+            rest-=num
+        if rest>0 and self.spillSize>0:
+            self.close()
+            with open(self.fileName,"rb") as f:
+                while rest>0:
+                    data=f.read(min(rest,1024*1024))
+                    if not data:
+                        break
+                    wf.write(data)
+                    if hasher!=None:
+                        hasher.update(data)
+                    rest-=len(data)
+        if rest>0:
+            raise ValueError("The size of the part is not enough")
+    def close(self)->None:
+        if self._file!=None:
+            self._file.close()
+            self._file=None
+    def release(self)->None:
+        """
+        Give back the blocks and remove the temp file.
+        """
+        self.close()
+        self.pool.give(self.blocks[:])
+        self.blocks.clear()
+        self.memorySize=0
+        if os.path.isfile(self.fileName):
+            os.remove(self.fileName)
+        self.spillSize=0
+    def __enter__(self):
+        return self
+    def __exit__(self,*args)->None:
+        self.close()
+class ConnectionLimiter:
+    """
+    A budget of connections shared by many downloads, with a global limit and a limit for every host.
+    When a connection is released, the subscribed callbacks are called in turn so that another download can take it.
+    """
+    def __init__(self,maxConnections:int=0,maxPerHost:int=0) -> None:
+        """
+        New a ConnectionLimiter object
+        :param maxConnections: max num of connections in total. If it's less than 1, it means infinity
+        :param maxPerHost: max num of connections to one host. If it's less than 1, it means infinity
+        """
+        self.maxConnections=maxConnections
+        self.maxPerHost=maxPerHost
+        self.total=0
+        self.hosts:dict={}
+        self._condition=threading.Condition()
+        self._callbacks:List[Callable[[], Any]]=[]
+        self._turn=0
+    def _free(self,host:str)->bool:
+        return (self.maxConnections<1 or self.total<self.maxConnections) and (self.maxPerHost<1 or self.hosts.get(host,0)<self.maxPerHost)
+    def acquire(self,host:str,block:bool=True)->bool:
+        """
+        Take a connection of the host.
+        :param host: the host of the connection
+        :param block: whether to wait until a connection is free
+        :return: True if we get the connection
+        """
+        with self._condition:
+            while not self._free(host):
+                if not block:
+                    return False
+                self._condition.wait()
+            self.total+=1
+            self.hosts[host]=self.hosts.get(host,0)+1
+            return True
+    def release(self,host:str,notify:bool=True)->None:
+        """
+        Give back a connection of the host.
+        :param host: the host of the connection
+        :param notify: whether to offer the free connection to the subscribed callbacks
+        """
+        with self._condition:
+            self.total-=1
+            self.hosts[host]-=1
+            self._condition.notify_all()
+            callbacks=self._callbacks[self._turn:]+self._callbacks[:self._turn]
+            self._turn=(self._turn+1)%max(len(self._callbacks),1)
+        if notify:
+            for i in callbacks:
+                i()
+    def subscribe(self,callback:Callable[[], Any])->None:
+        """
+        Call the callback when a connection is released.
+        :param callback: the callback. It should take the connection by acquire(block=False) or leave it
+        """
+        with self._condition:
+            self._callbacks.append(callback)
+    def unsubscribe(self,callback:Callable[[], Any])->None:
+        with self._condition:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+class StreamReader(io.RawIOBase):
+    """
+    The data of a download in order, while the parts are still downloading. Get it by AutoDownload.open.
+    It's a file object, an iterator of bytes and an async iterator of bytes.
+    The data after a gap is kept in memory up to bufferLimit. When it's full, the parts after the gap wait until it's read.
+    """
+    def __init__(self,download:"AutoDownload",bufferLimit:int) -> None:
+        """
+        New a StreamReader object
+        :param download: the download which writes the data
+        :param bufferLimit: max size of the data kept in memory
+        """
+        super().__init__()
+        self.download=download
+        self.bufferLimit=max(bufferLimit,1)
+        self.position:int=download.startSize
+        self.end:Union[None,int]=None
+        self.chunkSize=64*1024
+        self._chunks:dict={}
+        self._starts:List[int]=[]
+        self._buffered:int=0
+        self._condition=threading.Condition()
+        self._finished:bool=False
+        self._error:Union[None,BaseException]=None
+    def readable(self)->bool:
+        return True
+    def _room(self,position:int,length:int)->bool:
+        """
+        Whether the data can be put now. The data at the read position and the data after a gap nobody is filling are never held back.
+        """
+        if position+length<=self.position or self._buffered+length<=self.bufferLimit:
+            return True
+        return position<=self.position and self.position not in self._chunks
+    def room(self,position:int,length:int)->bool:
+        """
+        Whether the data can be put without waiting.
+        :param position: the position of the data
+        :param length: the length of the data
+        """
+        with self._condition:
+            return self.closed or self._room(position,length)
+    def put(self,position:int,data,part:Union[None,"_Part"]=None)->None:
+        """
+        Put the data at its position. The data we already have is dropped, so the parts may overlap. It waits while the buffer is full.
+        :param position: the position of the data
+        :param data: the data
+        :param part: the part which writes the data. If it's cancelled or it's holding up a lower part, the waiting stops with an error
+        """
+        with self._condition:
+            while not self._room(position,len(data)):
+                if self.closed:
+                    break
+                if part!=None and (part.cancel or self.download._streamStalled(part)):
+                    part.cancel=True
+                    raise ConnectionAbortedError("The buffer of the stream is full")
+                self._condition.wait(0.5)
+            if self.closed:
+                raise ValueError("The stream is closed")
+            if position<self.position:
+                data=data[self.position-position:]
+                position=self.position
+            end=position+len(data)
+            index=bisect.bisect_left(self._starts,position)
+            if index>0 and self._starts[index-1]+len(self._chunks[self._starts[index-1]])>position:
+                position=self._starts[index-1]+len(self._chunks[self._starts[index-1]])
+            pieces=[]
+            while position<end:
+                nextStart=self._starts[index] if index<len(self._starts) and self._starts[index]<end else end
+                if nextStart>position:
+                    pieces.append((position,bytes(data[position-end+len(data):nextStart-end+len(data)])))
+                if nextStart==end:
+                    break
+                position=nextStart+len(self._chunks[nextStart])
+                index+=1
+            for start,piece in pieces:
+                bisect.insort(self._starts,start)
+                self._chunks[start]=piece
+                self._buffered+=len(piece)
+            if pieces:
+                self._condition.notify_all()
+    def _finish(self,error:Union[None,BaseException]=None)->None:
+        """
+        The download is over. The reader gets EOF after the rest of the data, or the error.
+        :param error: the error of the download, None if it's successful
+        """
+        with self._condition:
+            self._finished=True
+            self._error=error
+            self._condition.notify_all()
+    def join(self,end:int)->bool:
+        """
+        Wait until all the data before end has been read.
+        :param end: the end position of the download
+        :return: False if the reader is closed before that
+        """
+        with self._condition:
+            self.end=end
+            self._condition.notify_all()
+            while self.position<end and not self.closed:
+                self._condition.wait(0.5)
+            return self.position>=end
+    def read(self,size:int=-1)->bytes:
+        """
+        Read the data. It waits until some data is ready, and returns less than size if no more data is ready.
+        :param size: max size of the data. If it's less than 0, read until EOF
+        :return: the data. b"" means EOF
+        """
+        if size<0:
+            return b"".join(iter(lambda:self.read(max(self.bufferLimit,self.chunkSize)),b""))
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        with self._condition:
+            while self.position not in self._chunks:
+                if self._finished and (self.end==None or self.position>=self.end):
+                    if self._error!=None:
+                        raise self._error
+                    return b""
+                self._condition.wait(0.5)
+            chunk=self._chunks.pop(self.position)
+            self._starts.pop(bisect.bisect_left(self._starts,self.position))
+            if len(chunk)>size:
+                self._chunks[self.position+size]=chunk[size:]
+                bisect.insort(self._starts,self.position+size)
+                chunk=chunk[:size]
+            self._buffered-=len(chunk)
+            self.position+=len(chunk)
+            self._condition.notify_all()
+        if self.download._hasher!=None:
+            self.download._hasher.update(chunk)
+        return chunk
+    def readinto(self,buffer)->int:
+        data=self.read(len(buffer))
+        buffer[:len(data)]=data
+        return len(data)
+    def close(self)->None:
+        """
+        Close the reader. A download which hasn't finished is stopped.
+        """
+        if self.closed:
+            return
+        super().close()
+        with self._condition:
+            self._chunks.clear()
+            self._starts.clear()
+            self._buffered=0
+            self._condition.notify_all()
+        if not self._finished:
+            self.download._abort()
+    def __iter__(self):
+        return self
+    def __next__(self)->bytes:
+        data=self.read(self.chunkSize)
+        if not data:
+            raise StopIteration
+        return data
+    def __aiter__(self):
+        return self
+    async def __anext__(self)->bytes:
+        data=await asyncio.get_running_loop().run_in_executor(None,self.read,self.chunkSize)
+        if not data:
+            raise StopAsyncIteration
+        return data
+class _StreamWriter:
+    """
+    The file object a part writes to when the download is streamed. It puts the data into the StreamReader.
+    """
+    def __init__(self,reader:StreamReader,position:int,part:Union[None,"_Part"]=None) -> None:
+        self.reader=reader
+        self.position=position
+        self.part=part
+    def write(self,data)->int:
+        self.reader.put(self.position,data,self.part)
+        self.position+=len(data)
+        return len(data)
+    def __enter__(self):
+        return self
+    def __exit__(self,*args)->None:
+        pass
+def _reflink(source:str,target:str)->bool:
+    """
+    Clone a file without copying the data, on the file systems which support it (btrfs, xfs, ...).
+    :param source: the file to clone
+    :param target: the new file
+    :return: True if the file is cloned
+    """
+    if fcntl==None:
+        return False
+    with open(source,"rb") as src,open(target,"wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(),0x40049409,src.fileno())#FICLONE
+            return True
+        except OSError:
+            return False
+def _placeFile(source:str,target:str,hardlink:bool)->None:
+    """
+    Put a copy of source at target by a hardlink, a reflink or a copy. The target is replaced at once.
+    :param source: the file to copy
+    :param target: the target file
+    :param hardlink: whether to try a hardlink first
+    """
+    temp="%s.%d.tmp"%(target,random.randrange(1<<30))
+    try:
+        try:
+            if not hardlink:
+                raise OSError
+            os.link(source,temp)
+        except OSError:
+            if not _reflink(source,temp):
+                shutil.copyfile(source,temp)
+        os.replace(temp,target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+class DownloadCache:
+    """
+    A cache of downloaded files on the disk, shared by the downloads which are given it.
+    A file is kept by its digest if the checksum is given with the digest, otherwise by its url with the ETag and Last-Modified of it.
+    A file kept by url is checked with If-None-Match and If-Modified-Since, and taken from the cache if the server answers 304.
+    The files used least recently are removed when the cache is larger than maxSize.
+    The index is locked with flock where fcntl is available, so a cache can be shared by processes.
+    """
+    def __init__(self,directory:Union[None,str]=None,maxSize:int=10*1024**3,hardlink:bool=False) -> None:
+        """
+        New a DownloadCache object
+        :param directory: where the files are kept. If it's None, it's ~/.cache/autoDownload
+        :param maxSize: max size of the files in the cache
+        :param hardlink: whether to hardlink the files between the cache and the targets. It's the fastest, but the file in the cache changes if the target is changed in place. Otherwise the files are reflinked if possible, or copied
+        """
+        self.directory=directory or os.path.join(os.path.expanduser("~"),".cache","autoDownload")
+        self.maxSize=maxSize
+        self.hardlink=hardlink
+        self.indexFile=os.path.join(self.directory,"index.json")
+        self.lockFile=os.path.join(self.directory,"index.lock")
+        self._lock=threading.Lock()
+        os.makedirs(os.path.join(self.directory,"blobs"),exist_ok=True)
+    def _blob(self,key:str)->str:
+        return os.path.join(self.directory,"blobs",hashlib.sha256(key.encode("utf-8")).hexdigest())
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the index between the threads, and between the processes if fcntl is available.
+        """
+        with self._lock:
+            if fcntl==None:
+                yield
+                return
+            with open(self.lockFile,"a") as f:
+                fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+    def _load(self)->dict:
+        try:
+            with open(self.indexFile,"r",encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            return {}
+    def _save(self,index:dict)->None:
+        temp="%s.%d.%d.tmp"%(self.indexFile,os.getpid(),random.randrange(1<<30))
+        try:
+            with open(temp,"w",encoding="utf-8") as f:
+                json.dump(index,f)
+            os.replace(temp,self.indexFile)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    def get(self,key:str)->Union[None,dict]:
+        """
+        Find a file in the cache.
+        :param key: the url, or "algorithm:hexdigest"
+        :return: the record of the file, with url, etag, lastModified, size and used. None if it isn't in the cache
+        """
+        with self._locked():
+            index=self._load()
+            entry=index.get(key)
+            if entry==None:
+                return None
+            if not os.path.isfile(self._blob(key)) or os.path.getsize(self._blob(key))!=entry["size"]:
+                del index[key]
+                self._save(index)
+                return None
+            entry["key"]=key
+            return entry
+    def restore(self,entry:dict,file:str)->None:
+        """
+        Put the cached file at file, and mark it used.
+        :param entry: the record got by get
+        :param file: the target file
+        """
+        _placeFile(self._blob(entry["key"]),file,self.hardlink)
+        with self._locked():
+            index=self._load()
+            if entry["key"] in index:
+                index[entry["key"]]["used"]=time.time()
+                self._save(index)
+    def put(self,key:str,file:str,url:str,etag:Union[None,str]=None,lastModified:Union[None,str]=None)->None:
+        """
+        Keep a file in the cache. The files used least recently are removed if the cache is too large, and so are the files left without a record.
+        :param key: the url, or "algorithm:hexdigest"
+        :param file: the file
+        :param url: the url of the file
+        :param etag: the ETag of the file
+        :param lastModified: the Last-Modified of the file
+        """
+        size=os.path.getsize(file)
+        if size>self.maxSize:
+            return
+        with self._locked():
+            _placeFile(file,self._blob(key),self.hardlink)
+            index=self._load()
+            index[key]={"url":url,"etag":etag,"lastModified":lastModified,"size":size,"used":time.time()}
+            total=sum(i["size"] for i in index.values())
+            for i in sorted(index,key=lambda i:index[i]["used"]):
+                if total<=self.maxSize:
+                    break
+                if i==key:
+                    continue
+                total-=index.pop(i)["size"]
+            blobs=set(os.path.basename(self._blob(i)) for i in index)
+            for i in os.listdir(os.path.join(self.directory,"blobs")):
+                if i not in blobs:
+                    try:
+                        os.remove(os.path.join(self.directory,"blobs",i))
+                    except OSError:
+                        pass
+            self._save(index)
+class JsonLinesExporter:
+    """
+    Write every event of the downloads to a file as a line of JSON. Give it to the hooks of the downloads.
+    """
+    def __init__(self,file:Union[str,io.TextIOBase]) -> None:
+        """
+        New a JsonLinesExporter object
+        :param file: the path of the file to append to, or a text file object
+        """
+        self._own=isinstance(file,str)
+        self.file=open(file,"a",encoding="utf-8") if self._own else file
+        self._lock=threading.Lock()
+    def __call__(self,event:dict)->None:
+        line=json.dumps(event,default=str)
+        with self._lock:
+            self.file.write(line+"\n")
+            self.file.flush()
+    def close(self)->None:
+        if self._own:
+            self.file.close()
+class PrometheusExporter:
+    """
+    Count the events of the downloads as Prometheus metrics. Give it to the hooks of the downloads,
+    and serve render() on a /metrics page, or write() it into the directory of the textfile collector of node_exporter.
+    """
+    def __init__(self,prefix:str="autodownload") -> None:
+        """
+        New a PrometheusExporter object
+        :param prefix: the prefix of the names of the metrics
+        """
+        self.prefix=prefix
+        self._counters:dict={}
+        self._summaries:dict={}
+        self._lock=threading.Lock()
+    def _count(self,name:str,value:float,**labels)->None:
+        key=(name,tuple(sorted(labels.items())))
+        self._counters[key]=self._counters.get(key,0)+value
+    def _observe(self,name:str,value:float)->None:
+        summary=self._summaries.setdefault(name,[0,0.0])
+        summary[0]+=1
+        summary[1]+=value
+    def __call__(self,event:dict)->None:
+        name=event["event"]
+        with self._lock:
+            if name=="connect":
+                self._count("connections_total",1)
+                self._observe("first_byte_seconds",event["firstByteTime"])
+                if event["connectTime"]!=None:
+                    self._observe("connect_seconds",event["connectTime"])
+            elif name=="part":
+                self._count("part_bytes_total",event["bytes"])
+                if event["seconds"]>0:
+                    self._observe("part_speed_bytes_per_second",event["speed"])
+            elif name=="retry":
+                self._count("retries_total",1,error=event["error"])
+            elif name=="split":
+                self._count("splits_total",1,kind=event["kind"])
+            elif name=="splice":
+                self._observe("splice_seconds",event["seconds"])
+            elif name=="finish":
+                self._count("downloads_total",1,result="success" if event["ok"] else "failure")
+                self._count("bytes_total",event["bytes"])
+                self._observe("download_seconds",event["seconds"])
+    def render(self)->str:
+        """
+        Get the metrics in the text format of Prometheus.
+        :return: the text
+        """
+        def escape(value)->str:
+            return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+        lines=[]
+        with self._lock:
+            for name in sorted(set(i[0] for i in self._counters)):
+                lines.append("# TYPE %s_%s counter"%(self.prefix,name))
+                for key,value in sorted(i for i in self._counters.items() if i[0][0]==name):
+                    labels=",".join('%s="%s"'%(i,escape(j)) for i,j in key[1])
+                    lines.append("%s_%s%s %s"%(self.prefix,name,"{%s}"%labels if labels else "",value))
+            for name,(count,total) in sorted(self._summaries.items()):
+                lines.append("# TYPE %s_%s summary"%(self.prefix,name))
+                lines.append("%s_%s_count %d"%(self.prefix,name,count))
+                lines.append("%s_%s_sum %s"%(self.prefix,name,total))
+        return "\n".join(lines)+"\n"
+    def write(self,file:str)->None:
+        """
+        Write the metrics to a file. The file is replaced at once, so that a collector never reads half of it.
+        :param file: the path of the file, like /var/lib/node_exporter/autodownload.prom
+        """
+        with open(file+".tmp","w",encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(file+".tmp",file)
 class MyTimeRemainingColumn(rich.progress.TimeRemainingColumn):
     def render(self, task: rich.progress.Task) -> rich.text.Text:
         """Show time remaining."""
@@ -57,7 +1056,7 @@ class _Part:
         :param start_: the start position of the part
         :param to: the end position of the part
         :param num: the num of the part
-        :param fileName: the tempfile name of the part
+        :param fileName: the tempfile name of the part. If the download has a BufferPool, only the data spilled from the memory goes to it
         :param stream: the response of the part
         """
         self.num=num
@@ -70,11 +1069,16 @@ class _Part:
         self.stream=stream
         self.progress:Union[None,rich.progress.TaskID]=None
         self.now:int=0
-        self.histoyTime:int=0
-        self.historyNum:int=0
-        self.speeds:str=""
+        self.sampleNum:int=0
         self.statueNum:int=0
         self.startTime:float=1.0
+        self.cancel:bool=False
+        self.hasher=None
+        self.digest:Union[None,str]=None
+        self.rival:Union[None,int]=None
+        self.mirror:Union[None,int]=0 if stream!=None else None
+        self.triedMirrors:set=set()
+        self.buffer:Union[None,_PartBuffer]=None
     def split(self,position:int):
         """
         Split the part into two parts. If the position is out of range, it will return empty _Part object after the self.to
@@ -90,16 +1094,37 @@ class _Part:
         if self.start!=other.start:
             return  self.start<other.start
         return self.to<other.to
+class _Mirror:
+    """
+    A source of the file. The speed is the speed of one connection to it.
+    """
+    def __init__(self,url:str,valid:Union[None,bool]=None) -> None:
+        """
+        New a Mirror object
+        :param url: the url
+        :param valid: whether it has the same file. None means it hasn't been checked
+        """
+        self.url=url
+        self.host=urllib.parse.urlsplit(url).netloc
+        self.valid=valid
+        self.speed:float=0
+        self.errors:int=0
 class AutoDownload:
-    def __init__(self,url:str,file:str,chunkSize:int=1024,maxRetry:int=5,maxThreadRetry:int=-1,timeout:Union[int,None]=30,continueDownloadTest:bool=False,startSize:int=0,openType:str="wb",
+    def __init__(self,url:str,file:Union[str,None],chunkSize:int=1024,maxRetry:int=5,maxThreadRetry:int=-1,timeout:Union[int,None]=30,continueDownloadTest:bool=False,startSize:int=0,openType:str="wb",
                  error:bool=True,log:bool=True,showProgressBar:bool=True,transient:bool=False,
-                 threaded:bool=False,threadNum:int=0,maxThreadNum:int=10,desiredCompletionTime:int=30,
-                 callbackFunction:Union[None,Callable[[bool], Any]]=None,deamon:bool=False,header:dict={})->None:
+                 threaded:bool=False,threadNum:int=0,maxThreadNum:int=10,desiredCompletionTime:int=30,adaptInterval:float=2.0,
+                 callbackFunction:Union[None,Callable[[bool], Any]]=None,deamon:bool=False,header:dict={},preallocate:bool=False,resume:bool=False,
+                 session:Union[None,requests.Session]=None,connectionLimiter:Union[None,ConnectionLimiter]=None,
+                 bufferSize:int=0,maxBufferSize:int=4*1024*1024,socketBufferSize:int=0,checksum:Union[None,str]=None,
+                 minSplitSize:int=1024*1024,hedge:bool=True,tailRatio:float=0.05,mirrors:Union[None,List[str]]=None,cache:Union[None,DownloadCache]=None,
+                 hooks:Union[None,List[Callable[[dict], Any]]]=None,profile:Union[None,str]=None,retryPolicy:Union[None,RetryPolicy]=None,
+                 maxSpeed:float=0,rateLimiter:Union[None,RateLimiter]=None,http2:int=0,smallFileSize:int=1024*1024,probe:bool=False,
+                 memoryBudget:int=64*1024*1024,bufferPool:Union[None,BufferPool]=None,tempDir:Union[None,str]=None)->None:
         """
         Download file from url to file
         :param url: url to download
-        :param file: file name
-        :param chunkSize: chunk size
+        :param file: file name. It's not used if the download is read by open
+        :param chunkSize: chunk size. It's used when the response can not be read into a buffer directly, and for splicing
         :param maxRetry: max retry times for the first connection. If it's less than 0, it means infinity
         :param maxThreadRetry: max retry times for the other connection. If it's less than 0, it means infinity
         :param continueDownloadTest: Whether to detect power interruption.
@@ -111,11 +1136,36 @@ class AutoDownload:
         :param transient: whether to keep progress after download
         :param threaded: whether to use thread for main thread
         :param callbackFunction: callback function
-        :param threadNum: num of thread. If threadNum < 1, we'll automatically calculates the threadNum based on the total size and the speed of the first thread
+        :param threadNum: num of thread. If threadNum < 1, we'll keep adding threads while the total speed goes up, and remove them when it stops going up or the errors rise
         :param maxThreadNum: max num of thread. It will be overlooked if threadNum >= 1
-        :param desiredCompletionTime: time in seconds. It is our reference value for calculating the threadNum
+        :param desiredCompletionTime: time in seconds. When a thread finishes, it only helps a part whose rest needs more time than this
+        :param adaptInterval: time in seconds between two adjustments of the num of threads when threadNum < 1
         :param deamon: whether to run in deamon mode.
         :param header: request header
+        :param preallocate: whether to preallocate the file and let every part write at its own offset. It saves the temp files and the splicing
+        :param resume: whether to keep a journal of the parts next to the file, so that a killed download can be resumed. It implies preallocate
+        :param session: the requests session used by all the parts. If it's None, we'll make one for this download
+        :param connectionLimiter: the connection budget shared with other downloads. The first connection waits for it, and the other parts only start when it has a free connection
+        :param maxSpeed: max bytes per second of this download. It can be changed while downloading. If it's less than or equal to 0, it means infinity
+        :param rateLimiter: the bandwidth shared with other downloads
+        :param http2: the num of HTTP/2 connections the parts share as streams. It needs httpx with h2. If it's less than 1 or the server doesn't support HTTP/2, every part has its own HTTP/1.1 connection by the requests session
+        :param bufferSize: the size of the buffer every part reads the socket into. If it's less than 1, it's sized by the speed of the part
+        :param maxBufferSize: max size of the buffer when it's sized by the speed
+        :param socketBufferSize: the SO_RCVBUF of every connection. If it's less than 1, the system default is used. It only works if we make the session
+        :param minSplitSize: min size of a part. A part is only split if both halves are not smaller than it
+        :param hedge: whether to race a slow part on a second connection near the end of the download. The one which finishes first wins and the other is cancelled
+        :param tailRatio: the rest of the download is the tail when it's less than this ratio of the file. Only the parts in the tail are raced
+        :param mirrors: other urls of the same file. The parts are shared among url and them by the speed of one connection to each, and a part goes to another one when its connection fails. A mirror is dropped if the size or the ETag of its file is different, or if it fails 3 times before it answers
+        :param cache: the cache of files. The file is taken from it if it's not modified on the server, and kept in it after it's downloaded. It's not used if startSize isn't 0, openType appends, or the download is read by open
+        :param hooks: functions called with every event of the download, like JsonLinesExporter and PrometheusExporter. An event is a dict with "event", "time", "url" and the data of it
+        :param profile: a path prefix. If it's given, the controller is run under cProfile and tracemalloc, and the results are written to profile+".prof" and profile+".memory.txt". Only the thread of the controller is profiled, which is all the download with AsyncAutoDownload
+        :param retryPolicy: how to wait before a retry of a connection. If it's None, we'll make a RetryPolicy with the default arguments
+        :param smallFileSize: a file not larger than it is read into memory by the first request and written at once, without the temp dir, the parts and the threads. If it's less than 0, there is no such fast path
+        :param probe: whether the first request only asks for the first smallFileSize bytes. A small file is still got by it, and for a larger one the probe goes on as the first part while the other parts start at once by their own ranges, since the size is known
+        :param memoryBudget: max bytes of the parts kept in memory when the file isn't preallocated. The rest of the data is spilled to the temp files. If it's less than 1, all the parts are written to the temp files
+        :param bufferPool: the memory shared with other downloads. It covers memoryBudget
+        :param tempDir: the directory for the temp dir of the download. If it's None, the temp dir of the system is used
+        :param checksum: how to check the data we download. It can be "algorithm:hexdigest" like "sha256:...", or just the algorithm to take the digest from the Digest, Repr-Digest, Content-MD5 or x-goog-hash header, or "auto" for any algorithm in these headers. The algorithm can be crc32, crc32c or one of hashlib
         """
         self.url = url
         self.file = file
@@ -132,6 +1182,10 @@ class AutoDownload:
         self.threadNum=threadNum
         self.maxThreadNum=maxThreadNum
         self.desiredCompletionTime=desiredCompletionTime
+        self.adaptInterval=adaptInterval
+        self._targetThreadNum=max(threadNum,1)
+        self._errorNum=0
+        self._adaptState:Union[None,dict]=None
         self._threadPool:List[threading.Thread] = []
         self._partition:List[_Part] =[]
         self._waitList:List[int]=[]
@@ -140,6 +1194,53 @@ class AutoDownload:
         self.timeout=timeout
         self.maxThreadRetry=maxThreadRetry
         self.fileSize:int=-1
+        self.preallocate=preallocate or resume
+        self._fileOffset:int=0
+        self.resume=resume
+        self.journalFile=self.file+".journal" if self.file!=None else ""
+        self._journal:Union[None,dict]=None
+        self.validators:dict={}
+        self.host=urllib.parse.urlsplit(self.url).netloc
+        self.connectionLimiter=connectionLimiter
+        self._limiter=RateLimiter(maxSpeed)
+        self.rateLimiter=rateLimiter
+        self._ownSession=session==None
+        if session==None:
+            session=_makeSession(max(self.threadNum,self.maxThreadNum,1),socketBufferSize)
+        self.session=session
+        if http2>=1 and httpx==None:
+            raise ImportError("HTTP/2 needs httpx. Install it by 'pip install httpx[http2]'")
+        self._http2Session=_Http2Session(http2,session.verify) if http2>=1 else None
+        self._useHttp2=self._http2Session!=None
+        self.smallFileSize=smallFileSize
+        self.probe=probe
+        self.acceptRanges:bool=True
+        self.bufferSize=bufferSize
+        self.maxBufferSize=maxBufferSize
+        self.checksum=checksum
+        self._checksumName:Union[None,str]=None
+        self._expectedDigest:Union[None,str]=None
+        if checksum!=None:
+            self._checksumName,_,expected=checksum.lower().partition(":")
+            self._expectedDigest=expected or None
+            if self._checksumName!="auto":
+                self._newHasher(self._checksumName)
+        self._hasher=None
+        self._hashThread:Union[None,threading.Thread]=None
+        self.digest:Union[None,str]=None
+        self._pending:List[tuple]=[]
+        self.minSplitSize=max(minSplitSize,1)
+        self.hedge=hedge
+        self.tailRatio=tailRatio
+        self._splitLock=threading.RLock()
+        self.retryPolicy=retryPolicy or RetryPolicy()
+        self.cache=cache
+        self.hooks:List[Callable[[dict], Any]]=list(hooks or [])
+        self.profile=profile
+        self._startTime:float=0
+        self._cacheEntry:Union[None,dict]=None
+        self.fromCache:bool=False
+        self._mirrors:List[_Mirror]=[_Mirror(url,True)]+[_Mirror(i) for i in mirrors or [] if i!=url]
         self.progress=rich.progress.Progress(
             rich.progress.TextColumn("[progress.description]{task.description}"),
             rich.progress.BarColumn(),
@@ -154,14 +1255,21 @@ class AutoDownload:
             transient=transient,
             disable=not showProgressBar
         )
-        self.tempFileDir=os.path.join(tempfile.gettempdir(),self.url.split("/")[-1].split("?")[0]+str(random.random()))
-        self.now=0
+        self.bufferPool=bufferPool if bufferPool!=None else BufferPool(max(memoryBudget,0))
+        self._output:Union[None,io.BufferedWriter]=None
+        self._outputName:str=""
+        self._outputStart:int=0
+        self._flushedTo:int=0
+        self.tempFileDir=os.path.join(tempDir or tempfile.gettempdir(),self.url.split("/")[-1].split("?")[0]+str(random.random()))
+        self.showProgressBar=showProgressBar
+        self._doneNum=0
         self.speed=0
-        self.speeds=""
         self.statue="init"
-        self.historyTime=1
-        self.historyNum=0
+        self._sampleTime=time.time()
+        self._sampleNum=0
         self.fail=False
+        self._lastError:Union[None,BaseException]=None
+        self._reader:Union[None,StreamReader]=None
     def _logShower(self,msg:str,level=logging.INFO):
         """
         Show log message through with self.logger. And if self.log is False, it will do nothing.
@@ -178,6 +1286,7 @@ class AutoDownload:
         """
         self._logShower("%s:%s"%(err.__class__.__name__,str(err)),logging.ERROR)
         self.fail=True
+        self._lastError=err
         if self.error:
             raise err
     def start(self)->Union[bool,None]:
@@ -185,16 +1294,77 @@ class AutoDownload:
         Start the download.
         :return: True if success, False if fail, None if self.threaded is True.
         """
-        if self.continueDownloadTest:
+        if self.resume and os.path.isfile(self.journalFile):
+            self._loadJournal()
+        if self.continueDownloadTest and self._journal==None:
             if os.path.isfile(self.file) and os.access(self.file,os.W_OK):#文件是否存在 and 是否可读
                 self.startSize=os.path.getsize(self.file)
                 self.openType="ab"
             else:
                 self._errorShower(FileNotFoundError("Can not open file '%s' for download."%(self.file)))
                 return False
-        os.makedirs(self.tempFileDir)
         if self.threaded:threading.Thread(target=self._wait,daemon=self.deamon,name="Download controller")
         else:return self._wait()
+    def _emit(self,event:str,**fields)->None:
+        """
+        Send an event to self.hooks. A hook which fails is only logged.
+        :param event: the name of the event
+        :param fields: the data of the event
+        """
+        if not self.hooks:
+            return
+        fields.update(event=event,time=time.time(),url=self.url)
+        for hook in self.hooks:
+            try:
+                hook(fields)
+            except Exception as err:
+                self._logShower("The hook %r fails. %s:%s"%(hook,err.__class__.__name__,str(err)),level=logging.WARNING)
+    def open(self,bufferLimit:int=64*1024*1024)->StreamReader:
+        """
+        Start the download in a thread, and read the data in order while the parts are downloading instead of writing the file.
+        The parts are put together in memory, so nothing is written to the disk and self.file is not used.
+        :param bufferLimit: max size of the data after a gap kept in memory. The parts after the gap wait when it's full
+        :return: the reader. Read it until EOF, or close it to stop the download
+        """
+        if self.resume:
+            raise ValueError("A streamed download can not be resumed")
+        self.preallocate=False
+        self._reader=StreamReader(self,bufferLimit)
+        threading.Thread(target=self._streamWait,daemon=True,name="Download controller").start()
+        return self._reader
+    def _streamWait(self)->None:
+        """
+        Run the download for the reader, and give the reader the error if it fails.
+        """
+        try:
+            retsult=self._wait()
+        except BaseException as err:
+            self._reader._finish(err)
+            return
+        self._reader._finish(None if retsult else self._lastError or ConnectError(self.url))
+    def _streamStalled(self,part:_Part)->bool:
+        """
+        Whether the part waiting for the buffer of the stream should give its connection to a lower range in self._pending.
+        :param part: the part
+        """
+        with self._splitLock:
+            return bool(self._pending) and self._pending[0][0]<part.start+part.now
+    def _abort(self)->None:
+        """
+        Stop the download. All the parts are cancelled and the controller returns False.
+        """
+        self.fail=True
+        for i in list(self._partition):
+            i.cancel=True
+    @property
+    def maxSpeed(self)->float:
+        """
+        Max bytes per second of this download. It can be changed while downloading.
+        """
+        return self._limiter.rate
+    @maxSpeed.setter
+    def maxSpeed(self,value:float)->None:
+        self._limiter.rate=value
     def changeUnit(self,num:Union[int,float])->str:
         """
         Change the unit of the data size.
@@ -208,77 +1378,186 @@ class AutoDownload:
             if num/(1024**i)<1024:
                 return "%.2f%s"%((num/(1024**i)),units[i])
         return ""
+    @property
+    def now(self)->int:
+        """
+        The size of the data we have got.
+        """
+        return self._doneNum+sum(i.now for i in list(self._partition))
     def _progressUpgrade(self,part:_Part,length:int):
         """
-        Updata the task.
+        Updata the task. Only the thread of the part writes its counter, so there is nothing to lock.
+        The speeds are worked out by _sample.
         :param part: the part to be updated
         :param length: the length of the new data
         """
-        t=int(time.time())
-        if t!=part.histoyTime:
-            part.speed=part.historyNum
-            part.speeds=self.changeUnit(part.speed)+"/s"
-            part.histoyTime=t
-            part.historyNum=length
-        if t!=self.historyTime and part.num==0:
-            self.speed=self.historyNum
-            self.speeds=self.changeUnit(self.speed)+"/s"
-            self.historyTime=t
-            self.historyNum=length
-        self.historyNum+=length
-        self.now+=length
-        part.historyNum+=length
         part.now+=length
+    def _sample(self)->None:
+        """
+        Work out the speed of every part and the total speed from their counters, at most once a second.
+        """
+        t=time.time()
+        if t-self._sampleTime<1:
+            return
+        for i in list(self._partition):
+            i.speed=0 if i.statue=="finished" else max(i.now-i.sampleNum,0)/(t-self._sampleTime)
+            i.sampleNum=i.now
+        if len(self._mirrors)>1:
+            self._sampleMirrors()
+        now=self.now
+        self.speed=max(now-self._sampleNum,0)/(t-self._sampleTime)
+        self._sampleNum=now
+        self._sampleTime=t
     def _updateProgressBar(self):
         """
         Control ProgressBar
         """
-        colors=["red","blue","green","gray","purple"]
-        statuesColor=["blue","yellow","green","red"]
         with self.progress:
-            self.total=self.progress.add_task("[yellow]Total",total=self.fileSize,start=False,speed="",size="",now="",statue="")
             while True:
                 time.sleep(0.1)
-                num=0
-                for i in self._partition:
-                    num+=1
-                    if i.progress!=None:
-                        self.progress.update(i.progress,completed =i.now,total=i.to-i.start,speed=i.speeds,size=self.changeUnit(i.to-i.start),now=self.changeUnit(i.now),statue=f"[{statuesColor[i.statueNum]}]{i.statue}[/{statuesColor[i.statueNum]}]")
-                    else:
-                        i.progress=self.progress.add_task("[%s]Thread%d"%(random.choice(colors),num),total=i.to-i.start,speed="",size="",now="",statue="init")
-                if self.fileSize>=0:
-                    self.progress.start_task(self.total)
-                self.progress.update(self.total,completed =self.now,total=self.fileSize,speed=self.speeds,size=self.changeUnit(self.fileSize),now=self.changeUnit(self.now),statue=f"[yellow]{self.statue}[/yellow]")
-    def _splitThread(self):
+                self._refreshProgressBar()
+    def _refreshProgressBar(self):
         """
-        Split the first part into multiple threads
+        Update the tasks of the ProgressBar once
         """
-        if self.threadNum<1:
-            while self._partition[0].speed==0:
-                time.sleep(1)
-            time.sleep(1)
-            if self.maxThreadNum<=0:
-                self._logShower("The maxThreadNum is less than or equal to 0. We try to download it in single thread.",level=logging.WARNING)
-                return
-            self.threadNum=min(self.maxThreadNum,int((self.fileSize)//(self._partition[0].speed*self.desiredCompletionTime)))
+        colors=["red","blue","green","gray","purple"]
+        statuesColor=["blue","yellow","green","red"]
+        num=0
+        for i in self._partition:
+            num+=1
+            if i.progress!=None:
+                self.progress.update(i.progress,completed =i.now,total=i.to-i.start,speed="--" if i.statue=="finished" else self.changeUnit(i.speed)+"/s",size=self.changeUnit(i.to-i.start),now=self.changeUnit(i.now),statue=f"[{statuesColor[i.statueNum]}]{i.statue}[/{statuesColor[i.statueNum]}]")
+            else:
+                i.progress=self.progress.add_task("[%s]Thread%d"%(random.choice(colors),num),total=i.to-i.start,speed="",size="",now="",statue="init")
+        if self.fileSize>=0:
+            self.progress.start_task(self.total)
+        now=self.now
+        self.progress.update(self.total,completed =now,total=self.fileSize,speed=self.changeUnit(self.speed)+"/s",size=self.changeUnit(self.fileSize),now=self.changeUnit(now),statue=f"[yellow]{self.statue}[/yellow]")
+    def _adaptThread(self):
+        """
+        Adjust the num of threads by the total speed until the download is over
+        """
+        while self._adaptConcurrency():
+            time.sleep(self.adaptInterval)
+    def _adaptConcurrency(self)->bool:
+        """
+        Adjust the num of threads once. It's a hill climbing on the total speed:
+        double the threads at first and add one at a time later while the speed goes up, take some back when it stops going up and hold for a while, and halve the threads when the errors rise.
+        :return: False if there is nothing to adjust anymore
+        """
+        if self.fail or (not self._waitList and not self._pending):
+            return False
+        if self.maxThreadNum<=0:
+            self._logShower("The maxThreadNum is less than or equal to 0. We try to download it in single thread.",level=logging.WARNING)
+            return False
+        now=time.time()
+        if self._adaptState==None:
+            if self._partition[0].speed==0:
+                return True
+            self._adaptState={"time":now,"now":self.now,"errors":self._errorNum,"speed":0.0,"action":"add","hold":0,"added":0,"slowStart":True}
+            self._adaptState["added"]=self._addConnection(1)
+            return True
+        state=self._adaptState
+        speed=(self.now-state["now"])/max(now-state["time"],1e-3)
+        errorRise=self._errorNum>state["errors"]
+        active=len(self._waitList)
+        if errorRise:
+            self._logShower("Errors rise. Reduce the threads to %d"%max(active//2,1),level=logging.DEBUG)
+            self._removeConnection(active-max(active//2,1))
+            state.update(action="remove",hold=3,slowStart=False)
+        elif state["hold"]>0:
+            state["hold"]-=1
+            state["action"]="hold"
+        elif state["action"]=="add" and state["added"] and speed<=state["speed"]*1.05:
+            num=max(state["added"]//2,1)
+            self._logShower("The speed stops going up. Reduce the threads to %d"%max(active-num,1),level=logging.DEBUG)
+            self._removeConnection(num)
+            state.update(action="remove",hold=3,slowStart=False)
+        else:
+            state["added"]=self._addConnection(active if state["slowStart"] else 1)
+            state["action"]="add" if state["added"] else "hold"
+        state.update(time=now,now=self.now,errors=self._errorNum,speed=speed)
+        self._emit("adapt",action=state["action"],threads=len(self._waitList),speed=speed)
+        return True
+    def _addConnection(self,num:int)->int:
+        """
+        Start pending parts or split the slowest parts to add threads.
+        :param num: the num of threads to add
+        :return: the num of threads added
+        """
+        added=0
+        with self._splitLock:
+            while added<num and len(self._waitList)<self.maxThreadNum and self._acquireConnection(False):
+                if self._pending:
+                    self._launchPart(heapq.heappop(self._pending)[1])
+                elif not self._split(self.adaptInterval):
+                    self._releaseConnection(False)
+                    break
+                added+=1
+            self._targetThreadNum=max(len(self._waitList),1)
+        return added
+    def _removeConnection(self,num:int)->None:
+        """
+        Stop the slowest parts, or the last parts if the download is streamed. The rest of them will wait in self._pending.
+        :param num: the num of threads to remove
+        """
+        with self._splitLock:
+            key=(lambda i:-self._partition[i].start) if self._reader!=None else (lambda i:self._partition[i].speed)
+            parts=sorted([i for i in self._waitList if self._partition[i].now>0 and not self._partition[i].cancel and self._partition[i].rival==None],key=key)
+            for i in parts[:max(min(num,len(parts)-1),0)]:
+                self._partition[i].cancel=True
+                self._targetThreadNum-=1
+            self._targetThreadNum=max(self._targetThreadNum,1)
+    def _splitFirst(self):
+        """
+        Split the last part into self.threadNum parts, but no part is smaller than self.minSplitSize
+        The last part is the whole file, or the rest of the file after the probe, which waits for the connection of the probe
+        """
+        last=self._partition[-1]
+        if last.statue=="finished" or not self.acceptRanges:
+            return
         if self.threadNum>1:
-            if self._partition[0].start+self._partition[0].now+(self.fileSize-self._partition[0].now)//(self.threadNum)>=self._partition[0].to:
-                return
-            self._partition.append(self._partition[0].split(self._partition[0].start+self._partition[0].now+(self.fileSize-self._partition[0].now)//(self.threadNum)))
-            self._partition[-1].num=1
-            elseSize=self._partition[-1].to-self._partition[-1].start
-            for i in range(2,self.threadNum):
-                self._partition.append(self._partition[-1].split(self._partition[-1].start+elseSize//(self.threadNum-1)))
-                self._partition[-1].num=i
-                
-            for i in range(1,len(self._partition)):
-                self._partition[i].fileName=os.path.join(self.tempFileDir,f"{i}.tmp")
-                self._threadPool.append(threading.Thread(target=self._download,daemon=True,args=[i]))
-                self._waitList.append(i)
-                self._threadPool[-1].start()
+            with self._splitLock:
+                threadNum=1
+                while threadNum<min(self.threadNum,self.fileSize//self.minSplitSize) and self._acquireConnection(False):
+                    threadNum+=1
+                if threadNum==1:
+                    return
+                if last.start+last.now+(last.to-last.start-last.now)//(threadNum)>=last.to:
+                    for i in range(1,threadNum):
+                        self._releaseConnection(False)
+                    return
+                first=len(self._partition)
+                self._partition.append(last.split(last.start+last.now+(last.to-last.start-last.now)//(threadNum)))
+                self._partition[-1].num=first
+                elseSize=self._partition[-1].to-self._partition[-1].start
+                for i in range(2,threadNum):
+                    self._partition.append(self._partition[-1].split(self._partition[-1].start+elseSize//(threadNum-1)))
+                    self._partition[-1].num=first+i-1
+
+                for i in range(first,len(self._partition)):
+                    self._partition[i].fileName=os.path.join(self.tempFileDir,f"{i}.tmp")
+                    self._launchPart(i)
+                    self._emit("split",kind="first",part=last.num,newPart=i,position=self._partition[i].start)
     def _wait(self)->bool:
-        retsult=self._controller()
+        self._startTime=time.time()
+        self._emit("start",file=self.file)
+        retsult=False
+        try:
+            if self.profile!=None:
+                retsult=self._profiledController()
+            else:
+                retsult=self._controller()
+        finally:
+            self._closeOutput(bool(retsult))
         self.progress.stop()
+        if self._ownSession:
+            self.session.close()
+        if self._http2Session!=None:
+            self._http2Session.close()
+        if retsult and not self.fromCache:
+            self._cacheStore()
+        self._emit("finish",ok=bool(retsult),seconds=time.time()-self._startTime,bytes=self.now,fileSize=self.fileSize,parts=len(self._partition),retries=self._errorNum,fromCache=self.fromCache,digest=self.digest)
         if retsult:
             self._logShower("Successfully!")
         else:
@@ -286,174 +1565,1700 @@ class AutoDownload:
         if self.callbackFunction!=None:
             self.callbackFunction(retsult)
         return retsult
+    def _profiledController(self)->bool:
+        """
+        Run the controller under cProfile and tracemalloc, and write the results next to self.profile.
+        """
+        profiler=cProfile.Profile()
+        tracing=not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        profiler.enable()
+        try:
+            return self._controller()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(self.profile+".prof")
+            snapshot=tracemalloc.take_snapshot()
+            current,peak=tracemalloc.get_traced_memory()
+            if tracing:
+                tracemalloc.stop()
+            with open(self.profile+".memory.txt","w",encoding="utf-8") as f:
+                f.write("current: %s, peak: %s\n"%(self.changeUnit(current),self.changeUnit(peak)))
+                for i in snapshot.statistics("lineno")[:30]:
+                    f.write(str(i)+"\n")
+            self._emit("profile",profile=self.profile+".prof",memory=self.profile+".memory.txt",peakMemory=peak)
     def _controller(self)->bool:
-        firstHeader=self.header.copy()
-        firstHeader["Range"]="bytes=%d-"%(self.startSize)
-        threading.Thread(target=self._updateProgressBar,daemon=True).start()
+        firstHeader=self._rangeHeader(self.startSize)
+        if self._cacheLookup(firstHeader):
+            return True
+        self.total=self.progress.add_task("[yellow]Total",total=self.fileSize,start=False,speed="",size="",now="",statue="")
+        showing=False
+        self.statue="waiting"
+        self._acquireConnection(True)
         for i in range(self.maxRetry):
             try:
                 self.statue="connecting"
-                retsult=requests.get(self.url,headers=firstHeader,stream=True,timeout=self.timeout)
-                if retsult.status_code//100 not in [2,3]:
-                    raise ConnectError(self.url)
-                if 'content-length' not in retsult.headers:
-                    self._logShower("Can not get the length of the file. try to download normally",level=logging.WARNING)
-                    with open(self.file,self.openType) as f:
-                        self.statue="downloading"
-                        for i in retsult.iter_content(chunk_size=self.chunkSize):
-                            t=int(time.time())
-                            if t!=self.historyTime:
-                                self.speed=self.historyNum
-                                self.speeds=self.changeUnit(self.speed)+"/s"
-                                self.histoyTime=t
-                                self.historyNum=len(i)
-                            self.historyNum+=len(i)
-                            self.now+=len(i)
-                            f.write(i)
-                    
-                    try:
-                        self.progress.update(self.total,speed=self.speeds,statue="[yellow]finished[/yellow]",now=self.changeUnit(self.now))
-                    except:
-                        pass
-                    self.progress.refresh()
+                self._sleep(self.retryPolicy.wait(self.host))
+                begin=time.time()
+                retsult=self._get(self.url,self._firstHeader(firstHeader))
+                self._emit("connect",part=0,source=self.url,status=retsult.status_code,firstByteTime=time.time()-begin,connectTime=_connectTime(retsult))
+                size=self._firstResponse(retsult,retsult.status_code,retsult.headers,firstHeader)
+                if size==None:
                     return True
-                self.fileSize=int(retsult.headers['content-length'])
-                if self.fileSize<=0:
-                    raise ZeroDivisionError(self.url)
-                self.statue="downloading"
-                self._partition.append(_Part(self.startSize,self.startSize+int(self.fileSize),0,os.path.join(self.tempFileDir,"0.tmp"),retsult))
-                self._threadPool.append(threading.Thread(target=self._download,daemon=True,args=[0]))
-                self._waitList.append(0)
-                self._threadPool[0].start()
+                if self._useHttp2 and retsult.httpVersion!="HTTP/2":
+                    self._logShower("The server does not support HTTP/2. Every part has its own connection",level=logging.INFO)
+                    self._useHttp2=False
+                if 0<=size<=self.smallFileSize:
+                    self.fileSize=size
+                    data=b"".join(retsult.iter_content(chunk_size=64*1024))
+                    retsult.close()
+                    return self._smallFile(data,retsult.headers)
+                if self.showProgressBar and not showing:
+                    threading.Thread(target=self._updateProgressBar,daemon=True).start()
+                    showing=True
+                if size<0:
+                    self._startWhole(retsult.headers)
+                    with self._openWhole() as f:
+                        for data in retsult.iter_content(chunk_size=self.chunkSize):
+                            self._writeWhole(f,data)
+                            self._throttle(len(data))
+                    return self._finishWhole()
+                resumed=self._startParts(retsult,retsult.status_code,retsult.headers,size)
                 break
                 
             except BaseException as err:
-                if i==self.maxRetry-1:
-                    self._errorShower(err)
+                delay=self._firstFailed(err,i)
+                if delay==None:
                     return False
-        threading.Thread(target=self._splitThread,daemon=True).start()
+                self._sleep(delay)
+        self._startHashThread()
+        if self.threadNum<1:
+            threading.Thread(target=self._adaptThread,daemon=True).start()
+        elif not resumed:
+            self._splitFirst()
         try:
             while True:
                 time.sleep(0.5)
-                if self.fail:
-                    return False
-                if not self._waitList:
-                    self.statue="finished"
-                    self.progress.update(self.total,completed=self.fileSize)
-                    self._logShower("All download finished. Start splicing",level=logging.DEBUG)
-                    splicing=self.progress.add_task("[yellow]splicing",total=self.fileSize,speed="",size="",now="",statue="")
-                    self._partition.sort()
-                    with open(self.file,self.openType) as wf:
-                        for i in self._partition:
-                            now=0
-                            with open(i.fileName,"rb") as f:
-                                while True:
-                                    data=f.read(self.chunkSize)
-                                    if now+len(data)>=i.to-i.start:
-                                        wf.write(data[:i.to-i.start-now])
-                                        self.progress.update(splicing,advance=i.to-i.start-now)
-                                        break
-                                    if not len(data):
-                                        self._errorShower(ValueError("The size of the part is not enough"))
-                                    now+=len(data)
-                                    wf.write(data)
-                                    self.progress.update(splicing,advance=len(data))
-                            try:
-                                os.remove(i.fileName)
-                            except:
-                                pass
-                    self.progress.update(splicing,completed=self.fileSize,statue="[green]finished[/green]")
-                    self.progress.refresh()
-                    return True
+                done=self._poll()
+                if done!=None:
+                    return done
         except BaseException as err:
             self._errorShower(err)
             return False
-    def _finished(self)->None:
+    def _firstResponse(self,response,status:int,headers,firstHeader:dict)->Union[None,int]:
         """
-        When a download thread is finished. Find another part which is the slowest to help.
+        Check the response of the first connection, and keep the validators of the file.
+        :param response: the response
+        :param status: the status code of the response
+        :param headers: the headers of the response
+        :param firstHeader: the header of the first connection
+        :return: the size of the file, -1 if it's unknown. None if the file is taken from the cache
         """
-        least={
-            "num":None,
-            "rest":0
-        }
-        for i in range(len(self._partition)):
-            if self._partition[i].statue=="finished":
+        if status==304 and self._cacheEntry!=None:
+            response.close()
+            if self._cacheHit(firstHeader):
+                self._releaseConnection()
+                return None
+            raise ConnectError(self.url)
+        if status//100 not in [2,3]:
+            response.close()
+            raise ConnectError(self.url,status,_retryAfter(headers))
+        self.retryPolicy.success(self.host)
+        self.validators={"etag":headers.get("etag"),"lastModified":headers.get("last-modified")}
+        return self._responseSize(status,headers)
+    def _firstFailed(self,err:BaseException,retryNum:int)->Union[None,float]:
+        """
+        The first connection failed. Show the error if it can't be retried.
+        :param err: the error
+        :param retryNum: the number of the try
+        :return: the seconds to wait before the next try. None if the download fails
+        """
+        self._emit("retry",part=0,source=self.url,error=err.__class__.__name__,message=str(err),retry=retryNum)
+        if retryNum==self.maxRetry-1 or isinstance(err,ChecksumError):
+            self._releaseConnection()
+            self._errorShower(err)
+            return None
+        self.retryPolicy.failure(self.host)
+        delay=self.retryPolicy.delay(retryNum,err)
+        self._logShower("%s:%s. Retry in %.2fs"%(err.__class__.__name__,str(err),delay),level=logging.WARNING)
+        return delay
+    def _poll(self)->Union[None,bool]:
+        """
+        Check the download once in the loop of the controller. The finished parts are flushed and the journal is saved.
+        :return: None if the download goes on, otherwise whether it succeeded
+        """
+        self._sample()
+        self._flushParts()
+        if self.resume:
+            self._writeJournal()
+        if self.fail:
+            return False
+        if not self._waitList and not self._pending:
+            return self._complete()
+        return None
+    def _complete(self)->bool:
+        """
+        All parts are finished. Flush the preallocated file, or splice the temp files into it.
+        :return: True if success
+        """
+        self.statue="finished"
+        self.progress.update(self.total,completed=self.fileSize)
+        if self._reader!=None:
+            self._logShower("All download finished. Wait for the reader",level=logging.DEBUG)
+            if not self._reader.join(self.startSize+self.fileSize):
+                return False
+            self._verify(False)
+            return True
+        if self.preallocate:
+            self._logShower("All download finished. Flush the file",level=logging.DEBUG)
+            with open(self.file,"r+b") as wf:
+                os.fsync(wf.fileno())
+            self._verify()
+            if self.resume:
+                os.remove(self.journalFile)
+            return True
+        self._logShower("All download finished. Start splicing",level=logging.DEBUG)
+        begin=time.time()
+        splicing=self.progress.add_task("[yellow]splicing",total=self.fileSize,completed=self._flushedTo-self.startSize if self._output!=None else 0,speed="",size="",now="",statue="")
+        self._flushParts(splicing)
+        for i in self._partition:
+            self._dropPart(i)
+        self._output.close()
+        self._output=None
+        shutil.rmtree(self.tempFileDir,ignore_errors=True)
+        self.progress.update(splicing,completed=self.fileSize,statue="[green]finished[/green]")
+        self._emit("splice",seconds=time.time()-begin,bytes=self.fileSize)
+        self.progress.refresh()
+        self._verify()
+        self._closeOutput(True)
+        return True
+    def _flushParts(self,task:Union[None,rich.progress.TaskID]=None)->None:
+        """
+        Write the finished parts at the head of the rest of the file into it in order, and drop their data.
+        It's called while downloading, so the memory of the parts is given back early, and at last to splice the rest.
+        :param task: the task of the ProgressBar to advance
+        """
+        if self.preallocate or self._reader!=None:
+            return
+        if self._output==None:
+            self._openOutput()
+        for i in sorted(list(self._partition)):
+            if i.to<=self._flushedTo:
                 continue
-            if self._partition[i].speed==0:
-                if self._partition[i].now==0:
-                    continue
-                speed=self._partition[i].now/(time.time()-self._partition[i].startTime)
-            else:
-                speed=self._partition[i].speed
-            if (self._partition[i].to-self._partition[i].start-self._partition[i].now)/speed>least["rest"]:
-                least["num"]=i
-                least["rest"]=(self._partition[i].to-self._partition[i].start-self._partition[i].now)/speed
-        if least["num"]==None:
-            self._logShower("No part need help, pass",level=logging.DEBUG)
+            if i.start>self._flushedTo or i.statue!="finished":
+                break
+            length=i.to-i.start
+            if i.buffer==None:
+                raise ValueError("The size of the part is not enough")
+            i.buffer.writeTo(self._output,length,self._hasher)
+            self._flushedTo=i.to
+            if task!=None and self.showProgressBar:
+                self.progress.update(task,advance=length)
+            self._dropPart(i)
+    def _openOutput(self)->None:
+        """
+        Open the file the parts are flushed into. If openType truncates the file, the parts go to self.file+".part", so that self.file is kept until the download succeeds.
+        """
+        self._outputName=self.file+".part" if "w" in self.openType else self.file
+        self._output=open(self._outputName,self.openType)
+        self._outputStart=self._output.tell()
+        self._fileOffset=self._outputStart-self.startSize
+        self._flushedTo=self.startSize
+    def _closeOutput(self,ok:bool)->None:
+        """
+        Close the file the parts are flushed into. If the download succeeds, it takes the place of self.file. Otherwise it's removed, or cut back to where we started appending.
+        It's called after the file is verified, so a file with a wrong checksum never takes the place of self.file.
+        :param ok: whether the download succeeds
+        """
+        if self._output!=None:
+            self._output.close()
+            self._output=None
+        if not self._outputName:
             return
-        self._logShower(f"Part {least['num']} is the slowest one. Split it.",level=logging.DEBUG)
-        if least["rest"]>self.desiredCompletionTime:
-            new=self._partition[least["num"]].split((self._partition[least["num"]].to-self._partition[least["num"]].start-self._partition[least["num"]].now)//2+self._partition[least["num"]].start+self._partition[least["num"]].now)
-            self._partition.append(new)
-            self._threadPool.append(threading.Thread(target=self._download,args=[len(self._partition)-1]))
-            self._partition[-1].fileName=os.path.join(self.tempFileDir,f"{len(self._partition)-1}.tmp")
-            self._waitList.append(len(self._partition)-1)
-            self._threadPool[-1].start()
-
-    def _download(self,partNum:int)->None:
+        if self._outputName!=self.file:
+            if ok:
+                os.replace(self._outputName,self.file)
+            else:
+                os.remove(self._outputName)
+        elif not ok:
+            os.truncate(self._outputName,self._outputStart)
+        self._outputName=""
+    def _dropPart(self,part:_Part)->None:
         """
-        The download thread
-        :param partNum: the partition number
+        Give back the memory of the part and remove its temp file if it's spilled.
+        :param part: the part
         """
-        part=self._partition[partNum]
-        header=self.header.copy()
-        header["Range"]="bytes=%d-"%(part.start)
-        part.statue="connecting"
-        part.statueNum=1
-        retryNum=0
-        while True:
-            try:
-                if part.stream==None:
-                    part.stream=requests.get(self.url,headers=header,stream=True,timeout=self.timeout)
-                if part.stream.status_code//100 not in [2,3]:
-                    raise ConnectError(self.url)
-                with open(part.fileName,"wb") as f:
-                    
-                    if retryNum:
+        if part.buffer!=None:
+            part.buffer.release()
+            part.buffer=None
+    def _cacheKey(self)->Union[None,str]:
+        """
+        The key of the file in self.cache.
+        :return: "algorithm:hexdigest" if the checksum is given with the digest, otherwise the url. None if the cache can't be used
+        """
+        if self.cache==None or self._reader!=None or self.startSize!=0 or "a" in self.openType or self.continueDownloadTest:
+            return None
+        if self._checksumName not in [None,"auto"] and self._expectedDigest!=None:
+            return "%s:%s"%(self._checksumName,self._expectedDigest)
+        return self.url
+    def _cacheLookup(self,header:dict)->bool:
+        """
+        Find the file in self.cache. A file kept by its digest is taken at once.
+        For a file kept by url, the ETag and Last-Modified of it are added to the header, so that the server answers 304 if it's not modified.
+        :param header: the header of the first connection
+        :return: True if the file is taken from the cache
+        """
+        key=self._cacheKey()
+        if key==None:
+            return False
+        entry=self.cache.get(key)
+        if entry==None:
+            return False
+        if key!=self.url:
+            self._cacheEntry=entry
+            return self._cacheHit(header)
+        if not (entry.get("etag") or entry.get("lastModified")):
+            return False
+        self._cacheEntry=entry
+        if entry.get("etag"):
+            header["If-None-Match"]=entry["etag"]
+        if entry.get("lastModified"):
+            header["If-Modified-Since"]=entry["lastModified"]
+        return False
+    def _cacheHit(self,header:dict)->bool:
+        """
+        Take the file from self.cache. If it fails, the header asks for the whole file again.
+        :param header: the header of the first connection
+        :return: True if the file is taken from the cache
+        """
+        entry=self._cacheEntry
+        self._cacheEntry=None
+        header.pop("If-None-Match",None)
+        header.pop("If-Modified-Since",None)
+        try:
+            self.cache.restore(entry,self.file)
+        except OSError as err:
+            self._logShower("Can not take the file from the cache. %s:%s"%(err.__class__.__name__,str(err)),level=logging.WARNING)
+            return False
+        self._logShower("The file is taken from the cache")
+        self.fromCache=True
+        self.fileSize=entry["size"]
+        self._doneNum=entry["size"]
+        self.validators={"etag":entry.get("etag"),"lastModified":entry.get("lastModified")}
+        self.statue="finished"
+        return True
+    def _cacheStore(self)->None:
+        """
+        Keep the downloaded file in self.cache. A file kept by url is only kept if it has an ETag or Last-Modified to check it next time.
+        """
+        key=self._cacheKey()
+        if key==None or (key==self.url and not (self.validators.get("etag") or self.validators.get("lastModified"))):
+            return
+        try:
+            self.cache.put(key,self.file,self.url,self.validators.get("etag"),self.validators.get("lastModified"))
+        except OSError as err:
+            self._logShower("Can not keep the file in the cache. %s:%s"%(err.__class__.__name__,str(err)),level=logging.WARNING)
+    def _newHasher(self,name:Union[None,str]=None):
+        """
+        Make a new checksum object.
+        :param name: the algorithm. If it's None, self._checksumName is used
+        :return: a hashlib object or a _Crc object. None if there is no checksum
+        """
+        name=name or self._checksumName
+        if name==None or name=="auto":
+            return None
+        if name in ["crc32","crc32c"]:
+            return _Crc(name)
+        return hashlib.new(name)
+    def _headerDigest(self,headers)->dict:
+        """
+        Read the digests of the file from the Digest, Repr-Digest, Content-MD5 and x-goog-hash headers.
+        :param headers: the headers of the response
+        :return: a dict of the hex digests by the algorithm
+        """
+        digests={}
+        items=[]
+        for key in ["x-goog-hash","digest","repr-digest"]:
+            if key in headers:
+                items+=headers[key].split(",")
+        if "content-md5" in headers:
+            items.append("md5="+headers["content-md5"])
+        for i in items:
+            name,_,value=i.strip().partition("=")
+            try:
+                digests[name.strip().lower().replace("-","")]=base64.b64decode(value.strip().strip(":")).hex()
+            except ValueError:
+                pass
+        return digests
+    def _startChecksum(self,headers)->None:
+        """
+        Find out the expected digest and make the hasher of the whole file.
+        It's called before the first part starts, so that a reader of the download hashes all the data.
+        :param headers: the headers of the first response
+        """
+        if self._checksumName==None:
+            return
+        if self._expectedDigest==None and self.startSize==0:
+            digests=self._headerDigest(headers)
+            if self._checksumName=="auto":
+                for i in ["sha512","sha256","sha1","md5","crc32c","crc32"]:
+                    if i in digests and (i!="crc32c" or crc32c!=None):
+                        self._checksumName=i
+                        break
+            self._expectedDigest=digests.get(self._checksumName)
+        if self._checksumName=="auto":
+            self._logShower("The server gives no digest we can check",level=logging.WARNING)
+            self._checksumName=None
+            return
+        self._hasher=self._newHasher()
+    def _startHashThread(self)->None:
+        """
+        With preallocate, read and check the file behind the parts while downloading, unless the parts' crc can be combined.
+        It's called after the parts are started, when the file is ready.
+        """
+        if self._hasher!=None and self.preallocate and self.fileSize>=0 and not isinstance(self._hasher,_Crc):
+            self._hashThread=threading.Thread(target=self._hashBehind,daemon=True)
+            self._hashThread.start()
+    def _hashBehind(self)->None:
+        """
+        Read the preallocated file behind the parts and update the checksum, as far as the data is continuous.
+        The gaps between the parts are the ranges finished before resuming. The file is read without a buffer, so that nothing is read ahead of the parts.
+        """
+        position=self.startSize
+        with open(self.file,"rb",buffering=0) as f:
+            while position<self.startSize+self.fileSize and not self.fail:
+                end=self.startSize
+                for i in sorted(list(self._partition)):
+                    end=max(end,i.start)
+                    if i.statue!="finished":
+                        end=max(end,i.start+min(i.now,i.to-i.start))
+                        break
+                    end=max(end,i.to)
+                else:
+                    end=self.startSize+self.fileSize
+                if end<=position:
+                    time.sleep(0.1)
+                    continue
+                f.seek(position+self._fileOffset)
+                while position<end:
+                    data=f.read(min(end-position,max(self.chunkSize,1024*1024)))
+                    if not data:
+                        break
+                    self._hasher.update(data)
+                    position+=len(data)
+    def _fileDigest(self)->str:
+        """
+        Read the data we downloaded from the file and work out the checksum. Before the file takes the place of self.file, the .part file is read.
+        :return: the hex digest
+        """
+        hasher=self._newHasher()
+        with open(self._outputName or self.file,"rb") as f:
+            f.seek(self.startSize+self._fileOffset)
+            rest=self.fileSize
+            while rest>0:
+                data=f.read(min(rest,1024*1024))
+                if not data:
+                    break
+                hasher.update(data)
+                rest-=len(data)
+        return hasher.hexdigest()
+    def _wholeDigest(self)->str:
+        """
+        Work out the checksum of the whole file. The crc of the parts are combined if they cover the file exactly, so that the file needn't be read.
+        :return: the hex digest
+        """
+        if self._hashThread!=None:
+            self._hashThread.join()
+            self._hashThread=None
+            return self._hasher.hexdigest()
+        if isinstance(self._hasher,_Crc) and self.preallocate:
+            return self._combinedDigest() or self._fileDigest()
+        return self._hasher.hexdigest()
+    def _combinedDigest(self)->Union[None,str]:
+        """
+        Combine the crc of the parts into the crc of the whole file.
+        :return: the hex digest. None if the checksum isn't a crc, or the crc of the parts don't cover the file exactly
+        """
+        if not isinstance(self._hasher,_Crc) or self._doneNum:
+            return None
+        parts=sorted(i for i in self._partition if i.to>i.start)
+        if not all(i.hasher!=None and i.digest!=None for i in parts):
+            return None
+        hasher=self._newHasher()
+        for i in parts:
+            hasher.combine(i.hasher)
+        return hasher.hexdigest()
+    def _verify(self,repair:bool=True)->None:
+        """
+        Check the checksum of the file. If it's wrong and the checksum is a crc which every part has, fetch the parts again on parallel connections and rewrite the parts whose crc changes, until the combined crc is right.
+        Other checksums can't tell which part is wrong, so the download fails.
+        :param repair: whether to fetch the parts again
+        """
+        if self._checksumName==None:
+            return
+        self.digest=self._wholeDigest()
+        if self._expectedDigest==None:
+            self._logShower("The %s of the file is %s"%(self._checksumName,self.digest))
+            return
+        if self.digest==self._expectedDigest:
+            self._logShower("The %s of the file is right"%self._checksumName,level=logging.DEBUG)
+            return
+        if not repair or not self.fileSize>0 or self._combinedDigest()==None:
+            raise ChecksumError(self.url,self._expectedDigest,self.digest)
+        self._logShower("The %s of the file is wrong. Check the parts again"%self._checksumName,level=logging.WARNING)
+        stop=threading.Event()
+        pool=concurrent.futures.ThreadPoolExecutor(max(self._targetThreadNum,1))
+        futures={pool.submit(self._refetch,i,stop):i for i in sorted(j for j in self._partition if j.to>j.start)}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if not future.result():
+                    continue
+                self._logShower("Part %d was corrupt and has been downloaded again"%self._partition.index(futures[future]),level=logging.WARNING)
+                self.digest=self._combinedDigest()
+                if self.digest==self._expectedDigest:
+                    return
+        finally:
+            stop.set()
+            for i in futures:
+                i.cancel()
+            pool.shutdown()
+        raise ChecksumError(self.url,self._expectedDigest,self.digest)
+    def _refetch(self,part:_Part,stop:threading.Event)->bool:
+        """
+        Download the range of the part again and write it into the file.
+        A failed connection is retried by self.retryPolicy, on another mirror if there is one.
+        :param part: the part
+        :param stop: it's set when the checksum is right, so the part needn't be fetched
+        :return: True if the data is different from what the part got
+        """
+        header=self._rangeHeader(part.start)
+        header["Range"]+="%d"%(part.to-1)
+        tried:set=set()
+        retryNum=0
+        while True:
+            if stop.is_set():
+                return False
+            mirror=self._chooseMirror(tried)
+            if mirror==None:
+                tried=set()
+                mirror=self._chooseMirror() or 0
+            source=self._mirrors[mirror]
+            try:
+                self._sleep(self.retryPolicy.wait(source.host))
+                hasher=self._newHasher()
+                size=0
+                response=self._get(source.url,header)
+                if response.status_code!=206:
+                    response.close()
+                    raise ConnectError(source.url,response.status_code,_retryAfter(response.headers))
+                with open(self._outputName or self.file,"r+b") as f:
+                    f.seek(part.start+self._fileOffset)
+                    for data in response.iter_content(chunk_size=max(self.chunkSize,64*1024)):
+                        f.write(data)
+                        hasher.update(data)
+                        size+=len(data)
+                response.close()
+                if size<part.to-part.start:
+                    raise ConnectionError("The connection closed before the part was fetched again")
+                self.retryPolicy.success(source.host)
+                break
+            except Exception as err:
+                self.retryPolicy.failure(source.host)
+                if retryNum==self.maxThreadRetry or self.fail:
+                    raise
+                tried.add(mirror)
+                delay=self.retryPolicy.delay(retryNum,err)
+                retryNum+=1
+                self._logShower("Fetch part %d again %s:%s. Retry in %.2fs"%(self._partition.index(part),err.__class__.__name__,str(err),delay),level=logging.WARNING)
+                self._sleep(delay)
+        if hasher.hexdigest()==part.digest:
+            return False
+        part.hasher=hasher
+        part.digest=hasher.hexdigest()
+        return True
+    def _acquireConnection(self,block:bool)->bool:
+        """
+        Take a connection from self.connectionLimiter.
+        :param block: whether to wait until a connection is free
+        :return: True if we get the connection
+        """
+        if self.connectionLimiter==None:
+            return True
+        return self.connectionLimiter.acquire(self.host,block)
+    def _releaseConnection(self,notify:bool=True)->None:
+        """
+        Give back a connection to self.connectionLimiter.
+        :param notify: whether to offer it to the other downloads
+        """
+        if self.connectionLimiter!=None:
+            self.connectionLimiter.release(self.host,notify)
+    def _schedulePart(self,partNum:int)->None:
+        """
+        Start the part if there is a free connection. Otherwise it waits in self._pending until a part is finished.
+        self._pending is a heap, so the lowest range starts first.
+        :param partNum: the partition number
+        """
+        if self._acquireConnection(False):
+            self._launchPart(partNum)
+        else:
+            heapq.heappush(self._pending,(self._partition[partNum].start,partNum))
+    def _launchPart(self,partNum:int)->None:
+        """
+        Start the download thread of a part. The connection of it must have been taken.
+        :param partNum: the partition number
+        """
+        self._threadPool.append(threading.Thread(target=self._download,daemon=True,args=[partNum]))
+        self._waitList.append(partNum)
+        self._threadPool[-1].start()
+    def _loadJournal(self)->None:
+        """
+        Read the journal left by a killed download. The file will be checked again when we know the size of the file.
+        """
+        try:
+            with open(self.journalFile,"r",encoding="utf-8") as f:
+                self._journal=json.load(f)
+            self.startSize=self._journal["startSize"]
+        except (OSError,ValueError,KeyError) as err:
+            self._logShower("Can not read the journal '%s', ignore it. %s:%s"%(self.journalFile,err.__class__.__name__,str(err)),level=logging.WARNING)
+            self._journal=None
+    def _writeJournal(self)->None:
+        """
+        Record the range of every part, so that we can go on after the program is killed.
+        A part only counts the data it has written, so the journal never claims more than the file has.
+        The parts are taken under self._splitLock, so that a part being split isn't recorded without its new half.
+        """
+        with self._splitLock:
+            parts=[[i.start,i.to,i.now] for i in self._partition]
+        journal={
+            "url":self.url,
+            "fileSize":self.fileSize,
+            "startSize":self.startSize,
+            "fileOffset":self._fileOffset,
+            "etag":self.validators.get("etag"),
+            "lastModified":self.validators.get("lastModified"),
+            "parts":parts
+        }
+        with open(self.journalFile+".tmp","w",encoding="utf-8") as f:
+            json.dump(journal,f)
+        os.replace(self.journalFile+".tmp",self.journalFile)
+    def _startParts(self,response,status:int,headers,size:int)->bool:
+        """
+        Start the download once the size of the file is known. The first response goes on as the first part.
+        If it's the response of the probe, the first part is only the range of it, and the rest of the file is the second part, which waits in self._pending for the connection of the probe.
+        :param response: the response of the first connection
+        :param status: the status code of the response
+        :param headers: the headers of the response
+        :param size: the size of the file
+        :return: True if the download is resumed from the journal
+        """
+        self.fileSize=size
+        if self.fileSize<=0:
+            raise ZeroDivisionError(self.url)
+        self._checkRanges(status,headers)
+        self.statue="downloading"
+        probe=self.probe and status==206
+        self._startChecksum(headers)
+        if self._resumeJournal(None if probe else response):
+            if probe:
+                response.close()
+            return True
+        if self.preallocate:
+            self._prepareFile()
+        self._partition.append(_Part(self.startSize,self.startSize+int(self.fileSize),0,os.path.join(self.tempFileDir,"0.tmp"),response))
+        if probe and self.startSize+max(self.smallFileSize,1)<self._partition[0].to:
+            self._partition.append(self._partition[0].split(self.startSize+max(self.smallFileSize,1)))
+            self._partition[1].num=1
+            self._partition[1].fileName=os.path.join(self.tempFileDir,"1.tmp")
+        self._launchPart(0)
+        if len(self._partition)>1:
+            heapq.heappush(self._pending,(self._partition[1].start,1))
+        return False
+    def _resumeJournal(self,response:Union[None,requests.Response])->bool:
+        """
+        Check the journal against the response of the first connection, and start the parts for the missing ranges.
+        :param response: the response of the first connection. None if it was only a probe
+        :return: True if the download is resumed from the journal
+        """
+        journal=self._journal
+        self._journal=None
+        if journal==None:
+            return False
+        if not self.acceptRanges:
+            self._logShower("The server does not support ranges. Download it again",level=logging.WARNING)
+            return False
+        if journal.get("fileSize")!=self.fileSize or journal.get("etag")!=self.validators["etag"] or journal.get("lastModified")!=self.validators["lastModified"]:
+            self._logShower("The file on the server has changed. Download it again",level=logging.WARNING)
+            return False
+        if not (self.validators["etag"] or self.validators["lastModified"]):
+            self._logShower("The server gives neither ETag nor Last-Modified. Resume by the size only",level=logging.WARNING)
+        if not os.path.isfile(self.file) or os.path.getsize(self.file)<journal["fileOffset"]+self.startSize+self.fileSize:
+            self._logShower("The file '%s' does not match the journal. Download it again"%self.file,level=logging.WARNING)
+            return False
+        self._fileOffset=journal["fileOffset"]
+        missing=[(start+now,to) for start,to,now in journal["parts"] if start+now<to]
+        self._doneNum=self.fileSize-sum(to-start for start,to in missing)
+        self._logShower("Resume from the journal. %d ranges are missing"%len(missing))
+        for start,to in missing:
+            part=_Part(start,to,len(self._partition),os.path.join(self.tempFileDir,f"{len(self._partition)}.tmp"))
+            if start==self.startSize and response!=None:
+                part.stream=response
+                part.mirror=0
+            self._partition.append(part)
+        if response!=None and (not self._partition or self._partition[0].stream==None):
+            response.close()
+        if not self._partition:
+            self._releaseConnection()
+            return True
+        self._launchPart(0)
+        for i in range(1,len(self._partition)):
+            self._schedulePart(i)
+        return True
+    def _prepareFile(self)->None:
+        """
+        Create the target file and reserve the space for the whole download, so that every part can write at its own offset.
+        """
+        if "a" in self.openType and os.path.isfile(self.file):
+            base=os.path.getsize(self.file)
+            mode="r+b"
+        else:
+            base=0
+            mode="wb"
+        self._fileOffset=base-self.startSize
+        with open(self.file,mode) as f:
+            try:
+                os.posix_fallocate(f.fileno(),base,self.fileSize)
+            except (AttributeError,OSError):
+                f.truncate(base+self.fileSize)
+    def _firstHeader(self,header:dict)->dict:
+        """
+        The header of the first request. If self.probe is True, it only asks for the first smallFileSize bytes.
+        :param header: the header for the rest of the file
+        :return: the header
+        """
+        if not self.probe:
+            return header
+        header=header.copy()
+        header["Range"]+="%d"%(self.startSize+max(self.smallFileSize,1)-1)
+        return header
+    def _responseSize(self,status:int,headers)->int:
+        """
+        Work out the size of the file from the first response. The total in Content-Range is used if the response is a part of the file, like the response of the probe.
+        :param status: the status code of the response
+        :param headers: the headers of the response
+        :return: the size from self.startSize. -1 if it's unknown
+        """
+        total=headers.get("content-range","").split("/")[-1].strip()
+        if status==206 and total.isdigit():
+            return int(total)-self.startSize
+        if "content-length" in headers:
+            return int(headers["content-length"])
+        return -1
+    def _checkRanges(self,status:int,headers)->None:
+        """
+        Find out whether the server supports Range by the first response. If it doesn't, the file is not split.
+        :param status: the status code of the response
+        :param headers: the headers of the response
+        """
+        self.acceptRanges=status==206 or headers.get("accept-ranges","").lower()=="bytes"
+        if not self.acceptRanges:
+            self._logShower("The server does not support Range. Download it by one connection",level=logging.WARNING)
+    def _smallFile(self,data:bytes,headers)->bool:
+        """
+        Write a small file which has been read into memory by one request, without the temp dir, the parts and the threads.
+        :param data: the data of the file
+        :param headers: the headers of the response
+        :return: True if success
+        """
+        if len(data)!=self.fileSize:
+            raise ConnectionError("The connection closed before the file finished")
+        self._logShower("The file is small. Download it by one request",level=logging.DEBUG)
+        self.preallocate=False
+        if self._reader==None or self._hasher==None:
+            self._startChecksum(headers)
+        with self._openWhole() as f:
+            f.write(data)
+        if self._hasher!=None and self._reader==None:
+            self._hasher.update(data)
+        self._doneNum=len(data)
+        self._releaseConnection()
+        if self._reader!=None and not self._reader.join(self.startSize+len(data)):
+            return False
+        self.statue="finished"
+        self.progress.update(self.total,completed=len(data))
+        self._verify(False)
+        if self.resume and os.path.isfile(self.journalFile):
+            os.remove(self.journalFile)
+        return True
+    def _startWhole(self,headers)->None:
+        """
+        The size of the file is unknown. Get ready to write the first response to the file as it comes.
+        :param headers: the headers of the response
+        """
+        self._logShower("Can not get the length of the file. try to download normally",level=logging.WARNING)
+        if self._reader==None or self._hasher==None:
+            self._startChecksum(headers)
+        self._doneNum=0
+        self.statue="downloading"
+    def _writeWhole(self,f,data:bytes)->None:
+        """
+        Write a chunk of the first response, when the size of the file is unknown.
+        :param f: the file object got by _openWhole
+        :param data: the chunk
+        """
+        f.write(data)
+        self._doneNum+=len(data)
+        if self._hasher!=None and self._reader==None:
+            self._hasher.update(data)
+        self._sample()
+    def _finishWhole(self)->bool:
+        """
+        The first response is over, when the size of the file is unknown. Wait for the reader and check the file.
+        :return: True if success
+        """
+        self._releaseConnection()
+        if self._reader!=None and not self._reader.join(self.startSize+self._doneNum):
+            return False
+        self.progress.update(self.total,speed=self.changeUnit(self.speed)+"/s",statue="[yellow]finished[/yellow]",now=self.changeUnit(self.now))
+        self.progress.refresh()
+        self._verify(False)
+        return True
+    def _openWhole(self):
+        """
+        Open the file the whole download writes to, when the size of the file is unknown.
+        :return: a file object
+        """
+        if self._reader!=None:
+            return _StreamWriter(self._reader,self.startSize)
+        return open(self.file,self.openType)
+    def _openPart(self,part:_Part):
+        """
+        Open the file the part writes to. If the download is streamed, the part writes to the reader, and if the file isn't preallocated, to its _PartBuffer.
+        :param part: the part
+        :return: a file object positioned where the part goes on, part.start+part.now
+        """
+        if self._reader!=None:
+            return _StreamWriter(self._reader,part.start+part.now,part)
+        if not self.preallocate:
+            if part.buffer==None:
+                part.buffer=_PartBuffer(self.bufferPool,part.fileName)
+            part.buffer.truncate(max(part.now,0))
+            return part.buffer
+        f=open(self.file,"r+b",buffering=0)
+        f.seek(part.start+part.now+self._fileOffset)
+        return f
+    def _partStopped(self,partNum:int)->None:
+        """
+        The stream of the part is over. If the part is cancelled, the rest of it waits in self._pending.
+        :param partNum: the partition number
+        """
+        part=self._partition[partNum]
+        if part.cancel and part.start+part.now<part.to:
+            with self._splitLock:
+                part.cancel=False
+                if part.now>0:
+                    self._partition.append(part.split(part.start+part.now))
+                else:
+                    self._partition.append(_Part(part.start,part.to))
+                    part.to=part.start
+                self._partition[-1].fileName=os.path.join(self.tempFileDir,f"{len(self._partition)-1}.tmp")
+                heapq.heappush(self._pending,(self._partition[-1].start,len(self._partition)-1))
+            self._logShower(f"Part {partNum} is stopped",level=logging.DEBUG)
+            self._emit("split",kind="stop",part=partNum,newPart=len(self._partition)-1,position=self._partition[-1].start)
+            self._partFinished(partNum,self._reader!=None)
+            return
+        if part.start+part.now<part.to:
+            raise ConnectionError("The connection of part %d closed before it finished"%partNum)
+        self._settleRace(partNum)
+        self._partFinished(partNum)
+    def _partFinished(self,partNum:int,steal:bool=True)->None:
+        """
+        Mark the part as finished and find another part to help.
+        :param partNum: the partition number
+        :param steal: whether to find another part to help
+        """
+        part=self._partition[partNum]
+        part.statue="finished"
+        part.statueNum=3
+        self._waitList.remove(partNum)
+        if part.hasher!=None:
+            part.digest=part.hasher.hexdigest() if part.now==part.to-part.start else None
+        seconds=time.time()-part.startTime if part.startTime>1 else 0
+        self._emit("part",part=partNum,source=self._sourceUrl(part),bytes=min(part.now,part.to-part.start),seconds=seconds,speed=min(part.now,part.to-part.start)/seconds if seconds>0 else 0)
+        part.now=part.to-part.start
+        part.speed=0
+        self._logShower(f"Part {partNum} is finished",level=logging.DEBUG)
+        self._releaseConnection()
+        if steal:
+            self._finished()
+    def _finished(self)->None:
+        """
+        When a download thread is finished. Start a pending part, or find another part which is the slowest to help.
+        """
+        if self.fail or len(self._waitList)>=self._targetThreadNum or not self._acquireConnection(False):
+            return
+        with self._splitLock:
+            if self._pending:
+                self._launchPart(heapq.heappop(self._pending)[1])
+                return
+            if not self._split(self.desiredCompletionTime):
+                self._releaseConnection(False)
+    def _sampleMirrors(self)->None:
+        """
+        Work out the speed of one connection to every mirror from the parts downloading from it.
+        """
+        parts=[i for i in list(self._partition) if i.statue!="finished" and i.speed>0 and i.mirror!=None]
+        for i in range(len(self._mirrors)):
+            speeds=[j.speed for j in parts if j.mirror==i]
+            if not speeds:
+                continue
+            mirror=self._mirrors[i]
+            speed=sum(speeds)/len(speeds)
+            mirror.speed=speed if mirror.speed==0 else mirror.speed*0.7+speed*0.3
+    def _chooseMirror(self,exclude:set=set())->Union[None,int]:
+        """
+        Choose the mirror for a new connection, so that the connections to every mirror are in proportion to its speed.
+        A mirror whose speed is unknown is taken as the fastest one, so that it will be tried. A mirror whose circuit breaker is open is the last choice.
+        :param exclude: the mirrors not to choose
+        :return: the index of the mirror. None if there is no mirror to choose
+        """
+        candidates=[i for i in range(len(self._mirrors)) if self._mirrors[i].valid!=False and i not in exclude]
+        if not candidates:
+            return None
+        speed=max([i.speed for i in self._mirrors],default=0) or 1
+        active=[self._partition[i].mirror for i in list(self._waitList)]
+        return min(candidates,key=lambda i:(self.retryPolicy.wait(self._mirrors[i].host)>0,(active.count(i)+1)/(self._mirrors[i].speed or speed)))
+    def _partUrl(self,part:_Part)->str:
+        """
+        Get the url the part downloads from. A mirror is chosen if the part has none.
+        :param part: the part
+        :return: the url
+        """
+        if part.mirror==None:
+            part.mirror=self._chooseMirror(part.triedMirrors)
+            if part.mirror==None:
+                part.triedMirrors.clear()
+                part.mirror=self._chooseMirror()
+        return self._mirrors[part.mirror].url
+    def _get(self,url:str,header:dict):
+        """
+        Send a streamed GET request, as a HTTP/2 stream if it's on and the server supports it.
+        :param url: the url
+        :param header: the header
+        :return: the response
+        """
+        if self._useHttp2:
+            return self._http2Session.get(url,headers=header,stream=True,timeout=self.timeout)
+        return self.session.get(url,headers=header,stream=True,timeout=self.timeout)
+    def _sourceUrl(self,part:_Part)->str:
+        """
+        The url the part is downloading from.
+        """
+        return self.url if part.mirror==None else self._mirrors[part.mirror].url
+    def _sourceHost(self,part:_Part)->str:
+        """
+        The host the part is downloading from.
+        """
+        return self.host if part.mirror==None else self._mirrors[part.mirror].host
+    def _checkMirror(self,part:_Part,status:int,headers)->None:
+        """
+        Check that the response of a mirror is the range of the same file. The mirror is dropped if it isn't.
+        :param part: the part
+        :param status: the status code of the response
+        :param headers: the headers of the response
+        """
+        mirror=self._mirrors[part.mirror]
+        if part.mirror==0 or mirror.valid:
+            return
+        total=headers.get("content-range","").rpartition("/")[2]
+        if status==200 and part.start==0:
+            total=headers.get("content-length","")
+        etag=headers.get("etag")
+        if status//100!=2 or not total.isdigit():
+            if status//100==4 and status!=429:
+                mirror.valid=False
+            raise ConnectError(mirror.url,status,_retryAfter(headers))
+        if int(total)!=self.startSize+self.fileSize or (etag!=None and self.validators.get("etag")!=None and etag!=self.validators["etag"]):
+            mirror.valid=False
+            self._logShower("The file on %s is not the same, drop it"%mirror.url,level=logging.WARNING)
+            raise MirrorError(mirror.url)
+        mirror.valid=True
+    def _failover(self,part:_Part)->bool:
+        """
+        The connection of the part failed. Give the part another mirror which it hasn't tried.
+        :param part: the part
+        :return: True if the part goes to another mirror. False if it has tried all of them, and the retry counts
+        """
+        if part.mirror==None or len(self._mirrors)<2:
+            return False
+        failed=self._mirrors[part.mirror]
+        failed.errors+=1
+        failed.speed/=2
+        if failed.valid==None and failed.errors>=3:
+            failed.valid=False
+            self._logShower("Can not connect to %s, drop it"%failed.url,level=logging.WARNING)
+        part.triedMirrors.add(part.mirror)
+        mirror=self._chooseMirror(part.triedMirrors)
+        if mirror==None:
+            part.triedMirrors.clear()
+            part.mirror=None
+            return False
+        self._logShower("Part %d goes to %s"%(self._partition.index(part),self._mirrors[mirror].url),level=logging.DEBUG)
+        part.mirror=mirror
+        return True
+    def _partSpeed(self,part:_Part)->float:
+        """
+        The speed of the part. Before it's sampled, the average speed since it started is used.
+        :param part: the part
+        :return: the speed. 0 if the part hasn't got any data
+        """
+        if part.speed==0 and part.now>0:
+            return part.now/max(time.time()-part.startTime,1e-3)
+        return part.speed
+    def _split(self,minRest:float)->bool:
+        """
+        Split the part which needs the most time and start the new part with the connection we have taken.
+        The running parts are kept in a priority queue by the time they still need, and the first one which is not smaller than twice of self.minSplitSize is split.
+        If no part can be split, try to race a slow part in the tail.
+        :param minRest: time in seconds. The part is only split if its rest needs more time than this
+        :return: True if a new part is started
+        """
+        if not self.acceptRanges:
+            return False
+        queue=[]
+        for i in range(len(self._partition)):
+            part=self._partition[i]
+            speed=self._partSpeed(part)
+            if part.statue=="finished" or part.cancel or speed==0:
+                continue
+            queue.append((-(part.to-part.start-part.now)/speed,i))
+        heapq.heapify(queue)
+        while queue:
+            rest,num=heapq.heappop(queue)
+            if -rest<=minRest:
+                break
+            part=self._partition[num]
+            if part.rival!=None or part.to-part.start-part.now<2*self.minSplitSize:
+                continue
+            self._logShower(f"Part {num} is the slowest one. Split it.",level=logging.DEBUG)
+            self._partition.append(part.split((part.to-part.start-part.now)//2+part.start+part.now))
+            self._partition[-1].fileName=os.path.join(self.tempFileDir,f"{len(self._partition)-1}.tmp")
+            self._launchPart(len(self._partition)-1)
+            self._emit("split",kind="split",part=num,newPart=len(self._partition)-1,position=self._partition[-1].start)
+            return True
+        if self._race():
+            return True
+        self._logShower("No part need help, pass",level=logging.DEBUG)
+        return False
+    def _race(self)->bool:
+        """
+        In the tail of the download, start a second connection for the rest of the slowest part, if it's much slower than the others.
+        Both of them download the same range. The one which finishes first wins, see _settleRace.
+        :return: True if a new part is started
+        """
+        if not self.hedge or self._pending or self.fileSize<=0:
+            return False
+        parts=[i for i in self._partition if i.statue!="finished"]
+        if sum(i.to-i.start-min(i.now,i.to-i.start) for i in parts)>self.fileSize*self.tailRatio:
+            return False
+        average=self.speed/max(len(self._waitList),1)
+        least={
+            "num":None,
+            "rest":1.0
+        }
+        for i in self._waitList:
+            part=self._partition[i]
+            speed=self._partSpeed(part)
+            if part.rival!=None or part.cancel or part.statue=="finished" or speed==0 or speed*2>average:
+                continue
+            if (part.to-part.start-part.now)/speed>least["rest"]:
+                least["num"]=i
+                least["rest"]=(part.to-part.start-part.now)/speed
+        if least["num"]==None:
+            return False
+        part=self._partition[least["num"]]
+        self._logShower(f"Part {least['num']} is slow in the tail. Race it on another connection.",level=logging.DEBUG)
+        rival=_Part(part.start+part.now,part.to,len(self._partition),os.path.join(self.tempFileDir,f"{len(self._partition)}.tmp"))
+        rival.rival=least["num"]
+        if part.mirror!=None and len(self._mirrors)>1:
+            rival.triedMirrors.add(part.mirror)
+        part.rival=len(self._partition)
+        self._partition.append(rival)
+        self._launchPart(len(self._partition)-1)
+        self._emit("split",kind="race",part=least["num"],newPart=len(self._partition)-1,position=rival.start)
+        return True
+    def _settleRace(self,partNum:int)->None:
+        """
+        The part has finished its range. If it is racing another part, the other one loses: it's cut to what the winner doesn't cover, and its connection is closed.
+        :param partNum: the partition number of the winner
+        """
+        with self._splitLock:
+            part=self._partition[partNum]
+            if part.rival==None:
+                return
+            loser=self._partition[part.rival]
+            part.rival=None
+            loser.rival=None
+            if loser.statue=="finished":
+                return
+            self._logShower(f"Part {partNum} wins the race",level=logging.DEBUG)
+            loser.to=part.start if loser.start<part.start else loser.start
+            loser.cancel=True
+            if loser.stream!=None:
+                try:
+                    loser.stream.close()
+                except BaseException:
+                    pass
+
+    def _rangeHeader(self,start:int)->dict:
+        """
+        Make the request header for the data from start.
+        The data is asked not to be compressed, so that the bytes we get are the bytes of the file.
+        :param start: the start position
+        :return: the header
+        """
+        header=self.header.copy()
+        header["Range"]="bytes=%d-"%(start)
+        if "accept-encoding" not in [i.lower() for i in header]:
+            header["Accept-Encoding"]="identity"
+        return header
+    def _partBufferSize(self,part:_Part)->int:
+        """
+        Work out the size of the buffer of the part. It's about 1/16 of the speed, so that the part still updates often.
+        :param part: the part
+        :return: the size
+        """
+        if self.bufferSize>=1:
+            return self.bufferSize
+        size=64*1024
+        while size<self.maxBufferSize and size*16<part.speed:
+            size*=2
+        return min(size,max(self.maxBufferSize,self.chunkSize))
+    def _receive(self,part:_Part,f)->None:
+        """
+        Read the stream of the part into f until the part is finished, cancelled or the stream is over.
+        If the response isn't compressed, it's read into one reused buffer by urllib3, which gives the connection back to the pool when the response is read to the end. Otherwise iter_content is used.
+        :param part: the part
+        :param f: the file object to write
+        """
+        raw=part.stream.raw
+        if raw==None or not hasattr(raw,"readinto") or part.stream.headers.get("content-encoding","identity")!="identity":
+            for data in part.stream.iter_content(chunk_size=self.chunkSize):
+                rest=part.to-part.start-part.now
+                if rest<=0 or part.cancel:
+                    break
+                if len(data)>rest:
+                    data=data[:rest]
+                f.write(data)
+                if part.hasher!=None:
+                    part.hasher.update(data)
+                self._progressUpgrade(part,len(data))
+                self._throttle(len(data),part)
+            return
+        speed=-1
+        view=memoryview(b"")
+        while True:
+            if part.speed!=speed:
+                speed=part.speed
+                size=self._partBufferSize(part)
+                if size!=len(view):
+                    view=memoryview(bytearray(size))
+            rest=part.to-part.start-part.now
+            if rest<=0 or part.cancel:
+                break
+            num=raw.readinto(view[:rest] if rest<len(view) else view)
+            if not num:
+                break
+            f.write(view[:num])
+            if part.hasher!=None:
+                part.hasher.update(view[:num])
+            self._progressUpgrade(part,num)
+            self._throttle(num,part)
+    def _throttleDelay(self,length:int,part:Union[None,_Part]=None)->float:
+        """
+        Take the tokens of the data from the rate limiters of this download and the shared one.
+        :param length: the length of the data
+        :param part: the part which gets the data. None for the first connection without length
+        :return: the seconds to wait
+        """
+        host=self.host if part==None else self._sourceHost(part)
+        delay=self._limiter.reserve(length,host)
+        if self.rateLimiter!=None:
+            delay=max(delay,self.rateLimiter.reserve(length,host))
+        return delay
+    def _throttle(self,length:int,part:Union[None,_Part]=None)->None:
+        """
+        Wait until the data is allowed by the rate limiters.
+        :param length: the length of the data
+        :param part: the part which gets the data
+        """
+        delay=self._throttleDelay(length,part)
+        if delay>0:
+            self._sleep(delay,part)
+    def _sleep(self,seconds:float,part:Union[None,_Part]=None)->None:
+        """
+        Wait before a retry or for the rate limiters. It stops at once if the download fails or the part is cancelled.
+        :param seconds: the time to wait
+        :param part: the part which waits
+        """
+        end=time.time()+seconds
+        while not self.fail and not (part!=None and part.cancel) and time.time()<end:
+            time.sleep(max(min(end-time.time(),0.1),0))
+    def _goOn(self,partNum:int,status:int)->None:
+        """
+        Check that the part can go on from part.start+part.now with the new response. If the server sends the whole file again, the first part starts again, and any other part fails since the data isn't at its offset.
+        A part only keeps its own hasher if the checksum is a crc, which can be combined and tells which part to fetch again.
+        :param partNum: the partition number
+        :param status: the status code of the response
+        """
+        part=self._partition[partNum]
+        if status!=206 and part.start>0:
+            raise ConnectError(self._sourceUrl(part),status)
+        if part.now>0 and status!=206:
+            self._logShower(f"Part {partNum} can not go on from where it stopped. Start it again",level=logging.WARNING)
+            part.now=0
+        if part.now==0:
+            part.startTime=time.time()
+            part.hasher=self._newHasher() if isinstance(self._hasher,_Crc) else None
+    def _download(self,partNum:int)->None:
+        """
+        The download thread. After a failure, it waits by self.retryPolicy and goes on from where the part stopped.
+        :param partNum: the partition number
+        """
+        part=self._partition[partNum]
+        part.statue="connecting"
+        part.statueNum=1
+        retryNum=0
+        while True:
+            try:
+                if part.stream==None:
+                    url=self._partUrl(part)
+                    self._sleep(self.retryPolicy.wait(self._sourceHost(part)),part)
+                    if part.cancel:
+                        self._partStopped(partNum)
+                        return
+                    begin=time.time()
+                    part.stream=self._get(url,self._rangeHeader(part.start+part.now))
+                    self._emit("connect",part=partNum,source=url,status=part.stream.status_code,firstByteTime=time.time()-begin,connectTime=_connectTime(part.stream))
+                self._checkMirror(part,part.stream.status_code,part.stream.headers)
+                if part.stream.status_code//100 not in [2,3]:
+                    raise ConnectError(self._sourceUrl(part),part.stream.status_code,_retryAfter(part.stream.headers))
+                self.retryPolicy.success(self._sourceHost(part))
+                self._goOn(partNum,part.stream.status_code)
+                with self._openPart(part) as f:
+                    if retryNum:
+                        part.statue=f"R:{retryNum} downloading"
+                    else:
+                        part.statue="downloading"
+                    self._logShower(f"Part {partNum} start downloading",level=logging.DEBUG)
+                    part.statueNum=2
+                    self._receive(part,f)
+                part.stream.close()
+                self._partStopped(partNum)
+                return
+
+            except BaseException as err:
+                if part.cancel:
+                    self._partStopped(partNum)
+                    return
+                self._errorNum+=1
+                self._emit("retry",part=partNum,source=self._sourceUrl(part),error=err.__class__.__name__,message=str(err),retry=retryNum)
+                if not isinstance(err,MirrorError):
+                    self.retryPolicy.failure(self._sourceHost(part))
+                if part.stream!=None:
+                    part.stream.close()
+                part.stream=None
+                if self._failover(part):
+                    self._logShower("Part %d %s:%s"%(partNum,err.__class__.__name__,str(err)),level=logging.WARNING)
+                    continue
+                if retryNum==self.maxThreadRetry:
+                    self._releaseConnection()
+                    self._errorShower(err)
+                    return
+                delay=self.retryPolicy.delay(retryNum,err)
+                retryNum+=1
+                part.statue=f"retry {retryNum}"
+                part.statueNum=1
+                self._logShower("Part %d %s:%s. Retry in %.2fs"%(partNum,err.__class__.__name__,str(err),delay),level=logging.WARNING)
+                self._sleep(delay,part)
+async def _traceConnectStart(session,context,params)->None:
+    context.trace_request_ctx["begin"]=time.time()
+async def _traceConnectEnd(session,context,params)->None:
+    times=context.trace_request_ctx
+    times["connectTime"]=times.get("connectTime",0)+time.time()-times["begin"]
+class AsyncAutoDownload(AutoDownload):
+    """
+    Download file from url to file like AutoDownload, but drive all the parts on one asyncio event loop instead of one thread per part.
+    It needs aiohttp. The parameters are the same as AutoDownload, except that session, connectionLimiter and http2 are not used.
+    """
+    def __init__(self,*args,**kwargs)->None:
+        if aiohttp==None:
+            raise ImportError("AsyncAutoDownload needs aiohttp. Install it by 'pip install aiohttp'")
+        super().__init__(*args,**kwargs)
+        if self.connectionLimiter!=None or self._http2Session!=None:
+            raise ValueError("AsyncAutoDownload does not support connectionLimiter and http2")
+        self._session:Union[None,"aiohttp.ClientSession"]=None
+        self._tasks:List[asyncio.Task]=[]
+    def _controller(self)->bool:
+        return asyncio.run(self._asyncController())
+    def _launchPart(self,partNum:int)->None:
+        """
+        Start the download task of a part on the event loop.
+        :param partNum: the partition number
+        """
+        self._tasks.append(asyncio.get_running_loop().create_task(self._asyncDownload(partNum)))
+        self._waitList.append(partNum)
+    async def _asyncProgressBar(self):
+        """
+        Control ProgressBar
+        """
+        while True:
+            await asyncio.sleep(0.1)
+            self._refreshProgressBar()
+    async def _asyncAdapt(self):
+        """
+        Adjust the num of tasks by the total speed until the download is over
+        """
+        while self._adaptConcurrency():
+            await asyncio.sleep(self.adaptInterval)
+    async def _asyncController(self)->bool:
+        firstHeader=self._rangeHeader(self.startSize)
+        if self._cacheLookup(firstHeader):
+            return True
+        self.total=self.progress.add_task("[yellow]Total",total=self.fileSize,start=False,speed="",size="",now="",statue="")
+        showing=False
+        timeout=aiohttp.ClientTimeout(sock_connect=self.timeout,sock_read=self.timeout)
+        trace=aiohttp.TraceConfig()
+        trace.on_connection_create_start.append(_traceConnectStart)
+        trace.on_connection_create_end.append(_traceConnectEnd)
+        async with aiohttp.ClientSession(timeout=timeout,connector=aiohttp.TCPConnector(limit=0),trace_configs=[trace]) as self._session:
+            for i in range(self.maxRetry):
+                try:
+                    self.statue="connecting"
+                    await asyncio.sleep(self.retryPolicy.wait(self.host))
+                    begin=time.time()
+                    times:dict={}
+                    retsult=await self._session.get(self.url,headers=self._firstHeader(firstHeader),trace_request_ctx=times)
+                    self._emit("connect",part=0,source=self.url,status=retsult.status,firstByteTime=time.time()-begin,connectTime=times.get("connectTime",0))
+                    size=self._firstResponse(retsult,retsult.status,retsult.headers,firstHeader)
+                    if size==None:
+                        return True
+                    if 0<=size<=self.smallFileSize:
+                        self.fileSize=size
+                        data=await retsult.read()
+                        retsult.close()
+                        return await asyncio.get_running_loop().run_in_executor(None,self._smallFile,data,retsult.headers)
+                    if self.showProgressBar and not showing:
+                        self.progress.start()
+                        self._tasks.append(asyncio.get_running_loop().create_task(self._asyncProgressBar()))
+                        showing=True
+                    if size<0:
+                        self._startWhole(retsult.headers)
+                        with self._openWhole() as f:
+                            async for data in retsult.content.iter_chunked(self.chunkSize):
+                                self._writeWhole(f,data)
+                                await self._asyncSleep(self._throttleDelay(len(data)))
+                        return await asyncio.get_running_loop().run_in_executor(None,self._finishWhole)
+                    resumed=self._startParts(retsult,retsult.status,retsult.headers,size)
+                    break
+                except Exception as err:
+                    delay=self._firstFailed(err,i)
+                    if delay==None:
+                        return False
+                    await asyncio.sleep(delay)
+            self._startHashThread()
+            if self.threadNum<1:
+                self._tasks.append(asyncio.get_running_loop().create_task(self._asyncAdapt()))
+            elif not resumed:
+                self._splitFirst()
+            try:
+                while True:
+                    await asyncio.sleep(0.5)
+                    done=self._poll()
+                    if done!=None:
+                        return done
+            except Exception as err:
+                self._errorShower(err)
+                return False
+            finally:
+                for i in self._tasks:
+                    i.cancel()
+    async def _asyncSleep(self,seconds:float,part:Union[None,_Part]=None)->None:
+        """
+        Wait before a retry or for the rate limiters. It stops at once if the download fails or the part is cancelled.
+        :param seconds: the time to wait
+        :param part: the part which waits
+        """
+        end=time.time()+seconds
+        while not self.fail and not (part!=None and part.cancel) and time.time()<end:
+            await asyncio.sleep(max(min(end-time.time(),0.1),0))
+    async def _asyncDownload(self,partNum:int)->None:
+        """
+        The download task. After a failure, it waits by self.retryPolicy and goes on from where the part stopped.
+        :param partNum: the partition number
+        """
+        part=self._partition[partNum]
+        part.statue="connecting"
+        part.statueNum=1
+        retryNum=0
+        while True:
+            try:
+                if part.stream==None:
+                    url=self._partUrl(part)
+                    await self._asyncSleep(self.retryPolicy.wait(self._sourceHost(part)),part)
+                    if part.cancel:
+                        self._partStopped(partNum)
+                        return
+                    begin=time.time()
+                    times={}
+                    part.stream=await self._session.get(url,headers=self._rangeHeader(part.start+part.now),trace_request_ctx=times)
+                    self._emit("connect",part=partNum,source=url,status=part.stream.status,firstByteTime=time.time()-begin,connectTime=times.get("connectTime",0))
+                self._checkMirror(part,part.stream.status,part.stream.headers)
+                if part.stream.status//100 not in [2,3]:
+                    raise ConnectError(self._sourceUrl(part),part.stream.status,_retryAfter(part.stream.headers))
+                self.retryPolicy.success(self._sourceHost(part))
+                self._goOn(partNum,part.stream.status)
+                with self._openPart(part) as f:
+                    if retryNum:
                         part.statue=f"R:{retryNum} downloading"
                     else:
                         part.statue="downloading"
                     self._logShower(f"Part {partNum} start downloading",level=logging.DEBUG)
                     part.statueNum=2
-                    part.startTime=time.time()
-                    part.now=0
-                    for data in part.stream.iter_content(chunk_size=self.chunkSize):
-                        if part.start+part.now>part.to:
-                            part.statue="finished"
-                            part.statueNum=3
-                            self._waitList.remove(partNum)
-                            part.now=part.to-part.start
-                            part.speed=0
-                            part.speeds="--"
-                            self._logShower(f"Part {partNum} is finished",level=logging.DEBUG)
-                            self._finished()
-                            return
+                    while True:
+                        rest=part.to-part.start-part.now
+                        if rest<=0 or part.cancel:
+                            break
+                        data=await part.stream.content.read(min(self._partBufferSize(part),rest))
+                        if not data:
+                            break
+                        while self._reader!=None and not self._reader.room(part.start+part.now,len(data)):
+                            if part.cancel or self._streamStalled(part):
+                                part.cancel=True
+                                raise ConnectionAbortedError("The buffer of the stream is full")
+                            await asyncio.sleep(0.05)
                         f.write(data)
+                        if part.hasher!=None:
+                            part.hasher.update(data)
                         self._progressUpgrade(part,len(data))
-                    part.statue="finished"
-                    part.statueNum=3
-                    self._waitList.remove(partNum)
-                    part.now=part.to-part.start
-                    part.speed=0
-                    part.speeds="--"
-                    self._logShower(f"Part {partNum} is finished",level=logging.DEBUG)
-                    self._finished()
+                        delay=self._throttleDelay(len(data),part)
+                        if delay>0:
+                            await self._asyncSleep(delay,part)
+                part.stream.close()
+                self._partStopped(partNum)
+                return
+            except Exception as err:
+                if part.cancel:
+                    self._partStopped(partNum)
                     return
-
-            except BaseException as err:
+                self._errorNum+=1
+                self._emit("retry",part=partNum,source=self._sourceUrl(part),error=err.__class__.__name__,message=str(err),retry=retryNum)
+                if not isinstance(err,MirrorError):
+                    self.retryPolicy.failure(self._sourceHost(part))
+                if part.stream!=None:
+                    part.stream.close()
+                part.stream=None
+                if self._failover(part):
+                    self._logShower("Part %d %s:%s"%(partNum,err.__class__.__name__,str(err)),level=logging.WARNING)
+                    continue
                 if retryNum==self.maxThreadRetry:
                     self._errorShower(err)
+                    return
+                delay=self.retryPolicy.delay(retryNum,err)
                 retryNum+=1
                 part.statue=f"retry {retryNum}"
                 part.statueNum=1
-                self._logShower("Part %d %s:%s"%(partNum,err.__class__.__name__,str(err)),level=logging.WARNING)
\ No newline at end of file
+                self._logShower("Part %d %s:%s. Retry in %.2fs"%(partNum,err.__class__.__name__,str(err),delay),level=logging.WARNING)
+                await self._asyncSleep(delay,part)
+_processShared=None
+_processSession:Union[None,requests.Session]=None
+def _processInit(shared)->None:
+    """
+    Set up a worker process of ProcessAutoDownload.
+    :param shared: the array of the parts shared with the parent. Every part has 3 numbers in it: the size it has got, the size it should get and the cancel flag
+    """
+    global _processShared
+    _processShared=shared
+def _processPart(slot:int,url:str,header:dict,file:str,position:int,start:int,now:int,timeout:Union[int,None],bufferSize:int,maxBufferSize:int,socketBufferSize:int,checksumName:Union[None,str])->tuple:
+    """
+    Download a part in a worker process of ProcessAutoDownload.
+    The data is written into the preallocated file at the offset of the part, and the progress is written into the shared array, where the parent puts the end of the part and the cancel flag.
+    :param slot: the index of the part in the shared array
+    :param url: url to download
+    :param header: the header of the request, with the range from position+now
+    :param file: the preallocated file
+    :param position: the position in the file where the part starts
+    :param start: the position of the part in the data. If it's not 0, only a 206 is written
+    :param now: the size the part has got. It goes on from there
+    :param timeout: the timeout of the connection
+    :param bufferSize: the size of the buffer. If it's less than 1, it grows with the speed up to maxBufferSize
+    :param maxBufferSize: max size of the buffer
+    :param socketBufferSize: the SO_RCVBUF of the connection
+    :param checksumName: crc32 or crc32c to work out the crc of the data we get, which the parent can combine. None for no checksum
+    :return: (the status code, the Retry-After, the crc, the length the crc covers, the size of the part where the crc starts)
+    """
+    global _processSession
+    try:
+        if _processSession==None:
+            _processSession=_makeSession(1,socketBufferSize)
+        shared=_processShared
+        base=slot*3
+        with _processSession.get(url,headers=header,stream=True,timeout=timeout) as response:
+            if response.status_code//100!=2:
+                return response.status_code,_retryAfter(response.headers),None,0,now
+            if start>0 and response.status_code!=206:
+                return response.status_code,None,None,0,now
+            if now>0 and response.status_code!=206:
+                now=0
+                shared[base]=0
+            hasher=None if checksumName==None else _Crc(checksumName)
+            if not hasattr(response.raw,"readinto") or response.headers.get("content-encoding","identity")!="identity":
+                raise ConnectionError("The response can not be read into a buffer")
+            size=bufferSize if bufferSize>=1 else 64*1024
+            view=memoryview(bytearray(size))
+            begin=time.time()
+            first=now
+            with open(file,"r+b",buffering=0) as f:
+                f.seek(position+now)
+                while not shared[base+2]:
+                    rest=shared[base+1]-now
+                    if rest<=0:
+                        break
+                    num=response.raw.readinto(view[:rest] if rest<len(view) else view)
+                    if not num:
+                        break
+                    f.write(view[:num])
+                    if hasher!=None:
+                        hasher.update(view[:num])
+                    now+=num
+                    shared[base]=now
+                    if bufferSize<1 and size<maxBufferSize and size*16<(now-first)/max(time.time()-begin,1e-3):
+                        size=min(size*2,maxBufferSize)
+                        view=memoryview(bytearray(size))
+            return response.status_code,None,None if hasher==None else hasher.value,0 if hasher==None else hasher.length,first
+    except BaseException as err:
+        raise ConnectionError("%s:%s"%(err.__class__.__name__,str(err))) from None
+class ProcessAutoDownload(AutoDownload):
+    """
+    Download file from url to file like AutoDownload, but run every part in a worker process, so that a fast link is not held back by one core.
+    The workers write into the preallocated file at the offsets of the parts and report the progress through shared memory, while the parts are still scheduled and split here.
+    The parameters are the same as AutoDownload. preallocate is always on, and mirrors, maxSpeed, rateLimiter, http2, session and open are not supported, since the workers make their own connections.
+    """
+    def __init__(self,*args,processNum:int=0,processContext:Union[None,str]=None,**kwargs)->None:
+        """
+        New a ProcessAutoDownload object
+        :param processNum: the num of worker processes. If it's less than 1, it will be maxThreadNum
+        :param processContext: the start method of the worker processes, "fork", "spawn" or "forkserver". If it's None, the default of multiprocessing is used
+        """
+        kwargs["preallocate"]=True
+        super().__init__(*args,**kwargs)
+        if len(self._mirrors)>1 or self.maxSpeed>0 or self.rateLimiter!=None or self._http2Session!=None or not self._ownSession:
+            raise ValueError("ProcessAutoDownload does not support mirrors, maxSpeed, rateLimiter, http2 and session")
+        self.processNum=processNum if processNum>=1 else max(self.maxThreadNum,self.threadNum,1)
+        self.processContext=processContext
+        self.socketBufferSize=kwargs.get("socketBufferSize",0)
+        slotNum=max(self.processNum,self.maxThreadNum,self.threadNum,1)*2+2
+        self._shared=multiprocessing.get_context(processContext).Array("q",slotNum*3,lock=False)
+        self._freeSlots=list(range(slotNum))
+        self._slotCondition=threading.Condition()
+        self._pool:Union[None,concurrent.futures.ProcessPoolExecutor]=None
+    def open(self,bufferLimit:int=64*1024*1024)->StreamReader:
+        raise ValueError("ProcessAutoDownload can not be read while downloading. Use AutoDownload.open")
+    def _controller(self)->bool:
+        self._pool=concurrent.futures.ProcessPoolExecutor(self.processNum,mp_context=multiprocessing.get_context(self.processContext),initializer=_processInit,initargs=(self._shared,))
+        try:
+            return super()._controller()
+        finally:
+            for i in range(len(self._shared)//3):
+                self._shared[i*3+2]=1
+            self._pool.shutdown(wait=False,cancel_futures=True)
+    def _launchPart(self,partNum:int)->None:
+        """
+        Start the thread which runs the part in a worker process. The connection of it must have been taken.
+        :param partNum: the partition number
+        """
+        self._threadPool.append(threading.Thread(target=self._processDownload,daemon=True,args=[partNum]))
+        self._waitList.append(partNum)
+        self._threadPool[-1].start()
+    def _combineCrc(self,part:_Part,name:Union[None,str]=None,value:Union[None,int]=None,length:int=0,first:int=0)->None:
+        """
+        Append the crc a worker worked out to the crc of the part. The crc of the part is dropped if it doesn't cover what the part has got, so that the file will be read to check it.
+        :param part: the part
+        :param name: crc32 or crc32c
+        :param value: the crc of the data the worker got. None if there is nothing to append
+        :param length: the length of the data the worker got
+        :param first: the size of the part where the data of the worker starts
+        """
+        if value!=None:
+            hasher=_Crc(name)
+            hasher.value=value
+            hasher.length=length
+            if first==0:
+                part.hasher=hasher
+            elif part.hasher!=None and part.hasher.length==first:
+                part.hasher.combine(hasher)
+            else:
+                part.hasher=None
+        if part.hasher!=None and part.hasher.length!=part.now:
+            part.hasher=None
+    def _processDownload(self,partNum:int)->None:
+        """
+        The thread of a part. It runs the part in a worker process and watches it: the progress is read from the shared array, and the end and the cancel flag of the part are written into it.
+        If all the slots of the shared array are taken, it waits for one.
+        After a failure, it waits by self.retryPolicy and goes on from where the part stopped.
+        :param partNum: the partition number
+        """
+        part=self._partition[partNum]
+        if part.stream!=None:
+            part.stream.close()
+            part.stream=None
+        part.statue="connecting"
+        part.statueNum=1
+        with self._slotCondition:
+            while not self._freeSlots and not part.cancel and not self.fail:
+                self._slotCondition.wait(0.1)
+            slot=self._freeSlots.pop() if self._freeSlots else None
+        if slot==None:
+            if part.cancel:
+                self._partStopped(partNum)
+            return
+        base=slot*3
+        retryNum=0
+        try:
+            while True:
+                try:
+                    self._sleep(self.retryPolicy.wait(self.host),part)
+                    if part.cancel:
+                        self._partStopped(partNum)
+                        return
+                    if part.now==0:
+                        part.startTime=time.time()
+                    checksumName=self._checksumName if self._checksumName in ["crc32","crc32c"] else None
+                    self._shared[base:base+3]=[part.now,part.to-part.start,0]
+                    future=self._pool.submit(_processPart,slot,self.url,self._rangeHeader(part.start+part.now),self.file,part.start+self._fileOffset,part.start,part.now,
+                                             self.timeout,self.bufferSize,max(self.maxBufferSize,self.chunkSize),self.socketBufferSize,checksumName)
+                    if retryNum:
+                        part.statue=f"R:{retryNum} downloading"
+                    else:
+                        part.statue="downloading"
+                    self._logShower(f"Part {partNum} start downloading in a worker process",level=logging.DEBUG)
+                    part.statueNum=2
+                    while True:
+                        done=concurrent.futures.wait([future],timeout=0.05).done
+                        part.now=self._shared[base]
+                        self._shared[base+1]=part.to-part.start
+                        if part.cancel or self.fail:
+                            self._shared[base+2]=1
+                        if done:
+                            break
+                    status,retryAfter,value,length,first=future.result()
+                    if status//100!=2 or (part.start>0 and status!=206):
+                        raise ConnectError(self.url,status,retryAfter)
+                    self.retryPolicy.success(self.host)
+                    self._combineCrc(part,checksumName,value,length,first)
+                    self._partStopped(partNum)
+                    return
+                except BaseException as err:
+                    if part.cancel:
+                        self._combineCrc(part)
+                        self._partStopped(partNum)
+                        return
+                    self._errorNum+=1
+                    self._emit("retry",part=partNum,source=self.url,error=err.__class__.__name__,message=str(err),retry=retryNum)
+                    self.retryPolicy.failure(self.host)
+                    if retryNum==self.maxThreadRetry or isinstance(err,concurrent.futures.process.BrokenProcessPool):
+                        self._releaseConnection()
+                        self._errorShower(err)
+                        return
+                    delay=self.retryPolicy.delay(retryNum,err)
+                    retryNum+=1
+                    part.statue=f"retry {retryNum}"
+                    part.statueNum=1
+                    self._logShower("Part %d %s:%s. Retry in %.2fs"%(partNum,err.__class__.__name__,str(err),delay),level=logging.WARNING)
+                    self._sleep(delay,part)
+        finally:
+            with self._slotCondition:
+                self._freeSlots.append(slot)
+                self._slotCondition.notify()
+class DownloadManager:
+    """
+    Download many files at the same time.
+    All the downloads share one requests session, one ConnectionLimiter, one RateLimiter, one RetryPolicy and one BufferPool, and a download takes the connection another one gives back to split its slowest part.
+    """
+    def __init__(self,maxConnections:int=16,maxPerHost:int=6,maxJobs:int=0,session:Union[None,requests.Session]=None,socketBufferSize:int=0,
+                 maxTotalSpeed:float=0,maxHostSpeed:float=0,memoryBudget:int=256*1024*1024,**kwargs)->None:
+        """
+        New a DownloadManager object
+        :param maxConnections: max num of connections of all the downloads. If it's less than 1, it means infinity
+        :param maxPerHost: max num of connections to one host. If it's less than 1, it means infinity
+        :param maxJobs: max num of downloads running at the same time. If it's less than 1, it will be maxConnections
+        :param session: the requests session shared by all the downloads. If it's None, we'll make one
+        :param socketBufferSize: the SO_RCVBUF of every connection if we make the session. If it's less than 1, the system default is used
+        :param maxTotalSpeed: max bytes per second of all the downloads. It can be changed by self.rateLimiter while downloading. If it's less than or equal to 0, it means infinity
+        :param maxHostSpeed: max bytes per second from one host. If it's less than or equal to 0, it means infinity
+        :param memoryBudget: max bytes of the parts all the downloads keep in memory. The rest is spilled to the temp files
+        :param kwargs: the default arguments of every AutoDownload. showProgressBar and error are False by default, and retryPolicy is one RetryPolicy shared by all the downloads
+        """
+        self.connectionLimiter=ConnectionLimiter(maxConnections,maxPerHost)
+        self.rateLimiter=RateLimiter(maxTotalSpeed,maxHostSpeed)
+        self.bufferPool=BufferPool(max(memoryBudget,0))
+        self.maxJobs=maxJobs if maxJobs>=1 else maxConnections
+        self._ownSession=session==None
+        if session==None:
+            session=_makeSession(max(maxPerHost,maxConnections,10) if maxPerHost<1 else maxPerHost,socketBufferSize)
+        self.session=session
+        self.kwargs={"showProgressBar":False,"error":False,"retryPolicy":RetryPolicy()}
+        self.kwargs.update(kwargs)
+        self.jobs:List[AutoDownload]=[]
+        self.logger=logging.getLogger("Download")
+    def add(self,url:str,file:str,**kwargs)->AutoDownload:
+        """
+        Add a download job.
+        :param url: url to download
+        :param file: file name. It's not used if the download is read by open
+        :param kwargs: the arguments of AutoDownload for this job. They cover the defaults of the manager
+        :return: the AutoDownload object of the job
+        """
+        arguments=self.kwargs.copy()
+        arguments.update(kwargs)
+        arguments["threaded"]=False
+        job=AutoDownload(url,file,session=self.session,connectionLimiter=self.connectionLimiter,rateLimiter=self.rateLimiter,bufferPool=self.bufferPool,**arguments)
+        self.jobs.append(job)
+        return job
+    def _run(self,job:AutoDownload)->bool:
+        """
+        Run a job and let it take the free connections while it is running.
+        :param job: the job
+        :return: True if success
+        """
+        self.connectionLimiter.subscribe(job._finished)
+        try:
+            return bool(job.start())
+        except BaseException as err:
+            self.logger.error("%s:%s"%(err.__class__.__name__,str(err)))
+            return False
+        finally:
+            self.connectionLimiter.unsubscribe(job._finished)
+    def start(self)->List[bool]:
+        """
+        Start all the jobs and wait for them.
+        :return: whether every job is successful, in the order they are added
+        """
+        results:List[bool]=[False]*len(self.jobs)
+        queue=list(range(len(self.jobs)))
+        lock=threading.Lock()
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    num=queue.pop(0)
+                results[num]=self._run(self.jobs[num])
+        workers=[threading.Thread(target=worker,daemon=True,name="Download manager") for i in range(min(len(self.jobs),self.maxJobs if self.maxJobs>=1 else len(self.jobs)))]
+        for i in workers:
+            i.start()
+        for i in workers:
+            i.join()
+        if self._ownSession:
+            self.session.close()
+        return results
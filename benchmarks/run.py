@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of autoDownload against the local server in server.py.
+
+It sweeps file size, chunkSize, threadNum, maxThreadNum and desiredCompletionTime. Every run is a new process,
+so the CPU time and the peak RSS are only of that download. For example:
+
+    python benchmarks/run.py --size 16M 256M --thread-num 0 4 16 --rate 4M --save base.json
+    python benchmarks/run.py --size 16M 256M --thread-num 0 4 16 --rate 4M --compare base.json
+
+With --compare, it exits with 1 if a run is slower or takes more CPU than the saved one beyond --tolerance.
+"""
+import argparse
+import ast
+import importlib.util
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import resource
+from typing import List, Union
+
+import rich.console
+import rich.table
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import server
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_KEYS=("size","chunkSize","threadNum","maxThreadNum","desiredCompletionTime")
+def loadPackage():
+    """
+    Import autoDownload. If it isn't installed, import it from this checkout.
+    :return: the module
+    """
+    try:
+        import autoDownload
+        return autoDownload
+    except ImportError:
+        spec=importlib.util.spec_from_file_location("autoDownload",os.path.join(ROOT,"__init__.py"),submodule_search_locations=[ROOT])
+        module=importlib.util.module_from_spec(spec)
+        sys.modules["autoDownload"]=module
+        spec.loader.exec_module(module)
+        return module
+def diskUsage(path:str)->int:
+    """
+    Get the size of the files in a directory.
+    :param path: the directory
+    :return: the size in bytes
+    """
+    size=0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    size+=entry.stat().st_blocks*512 if hasattr(os,"statvfs") else entry.stat().st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return size
+def child(config:dict)->None:
+    """
+    Run one download and print the result as JSON. It's the body of every benchmark process.
+    :param config: url, file, size, verify and the kwargs of AutoDownload
+    """
+    autoDownload=loadPackage()
+    download=getattr(autoDownload,config["cls"])(config["url"],config["file"],**config["kwargs"])
+    peak=0
+    running=True
+    def sampler():
+        nonlocal peak
+        while running:
+            peak=max(peak,diskUsage(download.tempFileDir))
+            time.sleep(0.05)
+    thread=threading.Thread(target=sampler,daemon=True)
+    thread.start()
+    begin=time.time()
+    try:
+        ok=bool(download.start())
+    except Exception as err:
+        print(repr(err),file=sys.stderr)
+        ok=False
+    seconds=time.time()-begin
+    running=False
+    thread.join()
+    if ok and os.path.getsize(config["file"])!=config["size"]:
+        ok=False
+    if ok and config["verify"]:
+        with open(config["file"],"rb") as f:
+            position=0
+            while data:=f.read(4*1024*1024):
+                if data!=server.generate(position,len(data)):
+                    ok=False
+                    break
+                position+=len(data)
+    print(json.dumps({"ok":ok,"seconds":seconds,"tempPeak":peak}))
+def startServer(args)->Union[subprocess.Popen,int]:
+    """
+    Start server.py in a new process.
+    :return: the process and its port
+    """
+    command=[sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),"server.py"),"--rate",args.rate,"--latency",str(args.latency),
+             "--jitter",str(args.jitter),"--error-rate",str(args.error_rate)]
+    if args.no_length:
+        command.append("--no-length")
+    if args.no_range:
+        command.append("--no-range")
+    process=subprocess.Popen(command,stdout=subprocess.PIPE,text=True)
+    return process,int(process.stdout.readline())
+def runOnce(config:dict)->dict:
+    """
+    Run one download in a new process, and measure its CPU time and peak RSS.
+    :param config: the config of child()
+    :return: the result
+    """
+    process=subprocess.Popen([sys.executable,os.path.abspath(__file__),"--child",json.dumps(config)],stdout=subprocess.PIPE,text=True)
+    output=process.stdout.read()
+    _,status,usage=os.wait4(process.pid,0)
+    process.returncode=os.waitstatus_to_exitcode(status)
+    lines=output.strip().splitlines()
+    result=json.loads(lines[-1]) if process.returncode==0 and lines else {"ok":False,"seconds":0,"tempPeak":0}
+    result["cpu"]=usage.ru_utime+usage.ru_stime
+    result["rss"]=usage.ru_maxrss*(1 if sys.platform=="darwin" else 1024)
+    if os.path.exists(config["file"]):
+        os.remove(config["file"])
+    return result
+def sweep(args,port:int)->List[dict]:
+    """
+    Run every combination of the arguments.
+    :return: the results
+    """
+    results=[]
+    workDir=tempfile.mkdtemp(prefix="autoDownloadBench")
+    kwargs=dict(showProgressBar=False,log=False,error=False)
+    for option in args.option:
+        key,_,value=option.partition("=")
+        kwargs[key]=ast.literal_eval(value)
+    try:
+        for combination in itertools.product(args.size,args.chunk_size,args.thread_num,args.max_thread_num,args.desired_completion_time):
+            case=dict(zip(_KEYS,combination))
+            size=server.parseSize(case["size"])
+            config={"url":"http://127.0.0.1:%d/%d"%(port,size),"file":os.path.join(workDir,"out.bin"),"size":size,"verify":args.verify,"cls":args.cls,
+                    "kwargs":dict(kwargs,chunkSize=case["chunkSize"],threadNum=case["threadNum"],maxThreadNum=case["maxThreadNum"],desiredCompletionTime=case["desiredCompletionTime"])}
+            runs=[runOnce(config) for _ in range(args.repeat)]
+            done=[run for run in runs if run["ok"]]
+            case["ok"]=len(done)==len(runs)
+            case["mbps"]=statistics.median([size/run["seconds"]/1024**2 for run in done]) if done else 0
+            case["cpu"]=statistics.median([run["cpu"] for run in done]) if done else 0
+            case["rss"]=max([run["rss"] for run in done],default=0)
+            case["tempPeak"]=max([run["tempPeak"] for run in done],default=0)
+            results.append(case)
+            if args.verbose:
+                print(json.dumps(case),file=sys.stderr)
+    finally:
+        shutil.rmtree(workDir,ignore_errors=True)
+    return results
+def compare(results:List[dict],baseline:List[dict],tolerance:float)->List[str]:
+    """
+    Find the runs worse than the baseline.
+    :return: the messages of regressions
+    """
+    old={tuple(case[key] for key in _KEYS):case for case in baseline}
+    messages=[]
+    for case in results:
+        base=old.get(tuple(case[key] for key in _KEYS))
+        if base==None:
+            continue
+        name=" ".join("%s=%s"%(key,case[key]) for key in _KEYS)
+        if base["ok"] and not case["ok"]:
+            messages.append("%s failed"%name)
+        elif case["mbps"]<base["mbps"]*(1-tolerance):
+            messages.append("%s: %.1f MB/s, was %.1f MB/s"%(name,case["mbps"],base["mbps"]))
+        elif case["cpu"]>base["cpu"]*(1+tolerance)+0.05:
+            messages.append("%s: %.2fs CPU, was %.2fs"%(name,case["cpu"],base["cpu"]))
+    return messages
+def show(results:List[dict])->None:
+    table=rich.table.Table(title="autoDownload benchmarks")
+    for name in ("size","chunkSize","threadNum","maxThreadNum","desiredCompletionTime","MB/s","CPU s","peak RSS MB","peak temp MB","ok"):
+        table.add_column(name,justify="right")
+    for case in results:
+        table.add_row(*[str(case[key]) for key in _KEYS],"%.1f"%case["mbps"],"%.2f"%case["cpu"],"%.1f"%(case["rss"]/1024**2),
+                      "%.1f"%(case["tempPeak"]/1024**2),"[green]yes[/green]" if case["ok"] else "[red]no[/red]")
+    rich.console.Console().print(table)
+def main():
+    if len(sys.argv)==3 and sys.argv[1]=="--child":
+        return child(json.loads(sys.argv[2]))
+    argparser=argparse.ArgumentParser(description="Benchmarks of autoDownload against a local server")
+    argparser.add_argument('--size',type=str,nargs="+",default=["16M"],help='File sizes, like 1M 64M 1G')
+    argparser.add_argument('--chunk-size',type=int,nargs="+",default=[1024],help='Values of chunkSize')
+    argparser.add_argument('--thread-num',type=int,nargs="+",default=[0],help='Values of threadNum. 0 means adaptive')
+    argparser.add_argument('--max-thread-num',type=int,nargs="+",default=[10],help='Values of maxThreadNum')
+    argparser.add_argument('--desired-completion-time',type=int,nargs="+",default=[30],help='Values of desiredCompletionTime')
+    argparser.add_argument('-o','--option',type=str,action="append",default=[],help='Other kwargs of AutoDownload, like -o preallocate=True')
+    argparser.add_argument('--cls',type=str,default="AutoDownload",choices=["AutoDownload","AsyncAutoDownload"],help='The class to benchmark')
+    argparser.add_argument('--repeat',type=int,default=1,help='Runs of every combination. The median is reported')
+    argparser.add_argument('--verify',action='store_true',help='Check the content of every download')
+    argparser.add_argument('--rate',type=str,default="0",help='Max bandwidth of every connection per second, like 2M. 0 means no limit')
+    argparser.add_argument('--latency',type=float,default=0,help='Time in seconds before every response')
+    argparser.add_argument('--jitter',type=float,default=0,help='Max random time in seconds added to the latency')
+    argparser.add_argument('--error-rate',type=float,default=0,help='The probability that a request fails')
+    argparser.add_argument('--no-length',action='store_true',help='The server answers without content-length')
+    argparser.add_argument('--no-range',action='store_true',help='The server ignores Range')
+    argparser.add_argument('--save',type=str,default=None,help='Save the results to this JSON file')
+    argparser.add_argument('--compare',type=str,default=None,help='Compare with the results saved by --save')
+    argparser.add_argument('--tolerance',type=float,default=0.15,help='Allowed loss of speed and gain of CPU time for --compare')
+    argparser.add_argument('-v','--verbose',action='store_true',help='Print every result when it is done')
+    args=argparser.parse_args()
+    process,port=startServer(args)
+    try:
+        results=sweep(args,port)
+    finally:
+        process.terminate()
+        process.wait()
+    show(results)
+    if args.save:
+        with open(args.save,"w") as f:
+            json.dump(results,f,indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            messages=compare(results,json.load(f),args.tolerance)
+        for message in messages:
+            print("Regression: "+message)
+        return 1 if messages else 0
+    return 0 if all(case["ok"] for case in results) else 1
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local HTTP server for the benchmarks. It serves generated data of any size at /<size>, for example /64M.
+It supports Range, and can limit the bandwidth of every connection, add latency and jitter, inject errors,
+and answer without content-length like the servers AutoDownload has to download normally.
+"""
+import http.server
+import random
+import re
+import socket
+import sys
+import time
+import argparse
+
+_PATTERN=random.Random(2007).randbytes((1<<20)+7)
+_BLOCK=64*1024
+def parseSize(text:str)->int:
+    """
+    Parse a size like 512, 64K, 10M or 1G.
+    :param text: the size
+    :return: the size in bytes
+    """
+    units={"":1,"K":1024,"M":1024**2,"G":1024**3}
+    match=re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?\s*",text.upper())
+    if match==None:
+        raise ValueError("Bad size '%s'"%text)
+    return int(float(match.group(1))*units[match.group(2)])
+def generate(position:int,length:int)->bytes:
+    """
+    Get the data of the generated file.
+    :param position: the start position
+    :param length: the length of the data
+    :return: the data
+    """
+    result=[]
+    while length>0:
+        offset=position%len(_PATTERN)
+        data=_PATTERN[offset:offset+length]
+        result.append(data)
+        position+=len(data)
+        length-=len(data)
+    return b"".join(result)
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+    rate:int=0
+    latency:float=0
+    jitter:float=0
+    errorRate:float=0
+    noLength:bool=False
+    noRange:bool=False
+    def log_message(self,*args)->None:
+        pass
+    def _range(self,size:int):
+        """
+        Parse the Range header.
+        :param size: the size of the file
+        :return: (start, end) of the range, or None for the whole file
+        """
+        match=re.fullmatch(r"bytes=(\d*)-(\d*)",self.headers.get("Range",""))
+        if self.noRange or self.noLength or match==None:
+            return None
+        if match.group(1):
+            start=int(match.group(1))
+            end=min(int(match.group(2)),size-1) if match.group(2) else size-1
+        else:
+            start=max(size-int(match.group(2)),0)
+            end=size-1
+        return start,end
+    def _answer(self,body:bool)->None:
+        try:
+            size=parseSize(self.path.strip("/").split(".")[0].split("?")[0])
+        except ValueError:
+            self.send_error(404)
+            return
+        time.sleep(self.latency+random.uniform(0,self.jitter))
+        if random.random()<self.errorRate/2:
+            self.send_response(503)
+            self.send_header("Retry-After","1")
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        ranged=self._range(size)
+        start,end=ranged or (0,size-1)
+        if start>=size:
+            self.send_response(416)
+            self.send_header("Content-Range","bytes */%d"%size)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        self.send_response(206 if ranged else 200)
+        self.send_header("ETag",'"%d"'%size)
+        self.send_header("Last-Modified","Sat, 01 Jan 2022 00:00:00 GMT")
+        if not self.noRange:
+            self.send_header("Accept-Ranges","bytes")
+        if ranged:
+            self.send_header("Content-Range","bytes %d-%d/%d"%(start,end,size))
+        if self.noLength:
+            self.send_header("Connection","close")
+            self.close_connection=True
+        else:
+            self.send_header("Content-Length",str(end-start+1))
+        self.end_headers()
+        if body:
+            self._send(start,end+1)
+    def _send(self,start:int,to:int)->None:
+        """
+        Send the data with the bandwidth limit, and break the connection at random if errors are injected.
+        """
+        breakAt=to
+        if random.random()<self.errorRate/2:
+            breakAt=random.randint(start,to)
+        begin=time.time()
+        position=start
+        try:
+            while position<to:
+                if position>=breakAt:
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection=True
+                    return
+                length=min(_BLOCK,breakAt-position)
+                self.wfile.write(generate(position,length))
+                position+=length
+                if self.rate>0:
+                    wait=(position-start)/self.rate-(time.time()-begin)
+                    if self.jitter:
+                        wait+=random.uniform(0,self.jitter)/16
+                    if wait>0:
+                        time.sleep(wait)
+        except (ConnectionError,OSError):
+            self.close_connection=True
+    def do_HEAD(self)->None:
+        self._answer(False)
+    def do_GET(self)->None:
+        self._answer(True)
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+    request_queue_size=256
+    def handle_error(self,request,clientAddress)->None:
+        if not isinstance(sys.exc_info()[1],(ConnectionError,OSError)):
+            super().handle_error(request,clientAddress)
+def main():
+    argparser=argparse.ArgumentParser(description="A local HTTP server with Range for the benchmarks. GET /<size> like /64M")
+    argparser.add_argument('-p','--port',type=int,default=0,help='The port. 0 means any free port. The port is printed on the first line')
+    argparser.add_argument('--rate',type=str,default="0",help='Max bandwidth of every connection per second, like 2M. 0 means no limit')
+    argparser.add_argument('--latency',type=float,default=0,help='Time in seconds before every response')
+    argparser.add_argument('--jitter',type=float,default=0,help='Max random time in seconds added to the latency')
+    argparser.add_argument('--error-rate',type=float,default=0,help='The probability that a request fails, by 503 or by a broken connection')
+    argparser.add_argument('--no-length',action='store_true',help='Answer without content-length and ignore Range')
+    argparser.add_argument('--no-range',action='store_true',help='Ignore Range')
+    args=argparser.parse_args()
+    Handler.rate=parseSize(args.rate)
+    Handler.latency=args.latency
+    Handler.jitter=args.jitter
+    Handler.errorRate=args.error_rate
+    Handler.noLength=args.no_length
+    Handler.noRange=args.no_range
+    server=Server(("127.0.0.1",args.port),Handler)
+    print(server.server_address[1],flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+if __name__=="__main__":
+    sys.exit(main())
@@ -1,22 +1,38 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from autoDownload import AutoDownload
+from autoDownload import AutoDownload,AsyncAutoDownload,ProcessAutoDownload,DownloadCache,JsonLinesExporter
 from rich import print as richPrint
 import os
+import sys
+import shutil
 
 
 def main():
     import argparse
     argparser = argparse.ArgumentParser()
     argparser.add_argument('Url', help = 'The URL of the file')
-    argparser.add_argument('-f', '--filename', type = str, default="", help="The filename of the file")
+    argparser.add_argument('-f', '--filename', type = str, default="", help="The filename of the file. '-' means writing the data to stdout while downloading")
     argparser.add_argument('-n', '--threadnum',type = int, default = 0, help = 'How many thread you want to download. 0 or lower means auto')
     argparser.add_argument('-m', '--max',type = int, default = 10, help = 'The max number of threads to download. It has to be greater than 0')
     argparser.add_argument('-r', '--retry', type = int, default = 5, help = "Max retry times for the first connection. If it's less than 0, it means infinity")
     argparser.add_argument('-tr', '--threadRetry', type = int, default = None, help = "Max retry times for the other thread. If it's less than 0, it means infinity")
     argparser.add_argument('-H', '--header', type = str, default = "{}", help = 'Header of the requests')
-    argparser.add_argument('-w', '--wish', type = float, default = 10.0, help = 'time in seconds. It is our reference value for calculating the threadNum')
+    argparser.add_argument('-w', '--wish', type = float, default = 10.0, help = 'time in seconds. When a thread finishes, it only helps a part whose rest needs more time than this')
+    argparser.add_argument('-p', '--preallocate', action = 'store_true', help = 'Preallocate the file and write every part at its own offset instead of splicing temp files')
+    argparser.add_argument('-c', '--resume', action = 'store_true', help = 'Keep a journal next to the file and resume from it if the download was killed')
+    argparser.add_argument('-a', '--asyncio', action = 'store_true', help = 'Drive all the parts on one asyncio event loop. It needs aiohttp')
+    argparser.add_argument('-x', '--process', action = 'store_true', help = 'Run every part in a worker process and write it into the preallocated file')
+    argparser.add_argument('-h2', '--http2', type = int, default = 0, help = 'The number of HTTP/2 connections the parts share. 0 means one HTTP/1.1 connection for every part. It needs httpx')
+    argparser.add_argument('-b', '--probe', action = 'store_true', help = 'Ask for the first bytes only to learn the size, then start all the parts at once')
+    argparser.add_argument('-M', '--mirror', type = str, action = 'append', default = None, help = 'Another URL of the same file. It can be given more than once')
+    argparser.add_argument('-k', '--cache', type = str, default = None, help = 'The directory of the cache. The file is taken from it if it is not modified on the server')
+    argparser.add_argument('-j', '--trace', type = str, default = None, help = 'Append the events of the download to this file as JSON lines')
+    argparser.add_argument('-P', '--profile', type = str, default = None, help = 'Profile the download by cProfile and tracemalloc, and write the results to this path prefix')
+    argparser.add_argument('-l', '--limit', type = float, default = 0, help = 'Max speed in bytes per second. 0 means no limit')
+    argparser.add_argument('-B', '--memory', type = int, default = 64*1024*1024, help = 'Max bytes of the parts kept in memory. The rest is spilled to the temp files. 0 means all the parts are in the temp files')
+    argparser.add_argument('-t', '--tempdir', type = str, default = None, help = 'The directory for the temp files. The temp dir of the system by default')
+    argparser.add_argument('-s', '--checksum', type = str, default = None, help = 'Check the file. "algorithm:hexdigest", or the algorithm to take the digest from the headers, or "auto"')
     args = argparser.parse_args()
     
     try:
@@ -34,16 +50,34 @@ def main():
     try:
         if filename=="":
             raise ValueError("Can not get the name of the file by URL. Please set it by '-f' or '--filename'")
-        retsult=AutoDownload(
+        download=(AsyncAutoDownload if args.asyncio else ProcessAutoDownload if args.process else AutoDownload)(
             url = args.Url,
-            file = filename,
+            file = None if filename=="-" else filename,
             maxRetry=args.retry,
             threadNum=args.threadnum,
             maxThreadNum=args.max,
             maxThreadRetry=args.threadRetry,
             header=headers,
-            desiredCompletionTime=args.wish
-        ).start()
+            desiredCompletionTime=args.wish,
+            preallocate=args.preallocate,
+            resume=args.resume,
+            checksum=args.checksum,
+            mirrors=args.mirror,
+            cache=None if args.cache==None else DownloadCache(args.cache),
+            hooks=None if args.trace==None else [JsonLinesExporter(args.trace)],
+            profile=args.profile,
+            maxSpeed=args.limit,
+            http2=args.http2,
+            probe=args.probe,
+            memoryBudget=args.memory,
+            tempDir=args.tempdir,
+            showProgressBar=filename!="-"
+        )
+        if filename=="-":
+            with download.open() as reader:
+                shutil.copyfileobj(reader,sys.stdout.buffer,1024*1024)
+            return
+        retsult=download.start()
         if retsult:
             richPrint("[green]Successfully downloaded the file.[/green]")
             richPrint(f"The file was saved at [yellow]{os.path.abspath(filename)}[/yellow]")